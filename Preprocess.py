@@ -3,6 +3,21 @@
 import os
 import shutil
 
+import instrument
+
+# Summary exports that are not used, matched on the lower case file name
+SUMMARY_PREFIXES = ('heartsummary', 'activiessummary', 'sleepsummary', 'stepssummary')
+
+
+def is_summary(filename):
+    """
+        Checks if a file is one of the summary csv files that are not used
+
+        :param filename: name of the file
+        :return: True for summary csv files
+    """
+    return filename.lower().startswith(SUMMARY_PREFIXES) and filename.lower().endswith('.csv')
+
 
 def extract_months(path):
     """
@@ -40,11 +55,7 @@ def delete_unused(path):
         if os.path.isdir(os.path.join(path, folder_name)):
             fitbit_data_path = path + "/" + folder_name + "/Fitbit/"
             files = os.listdir(fitbit_data_path)
-            heartsummeray_files = [file for file in files if
-                                   (file.lower().startswith('heartsummary') and file.lower().endswith('.csv')
-                                    or file.lower().startswith('activiessummary') and file.lower().endswith('.csv')
-                                    or file.lower().startswith('sleepsummary') and file.lower().endswith('.csv')
-                                    or file.lower().startswith('stepssummary') and file.lower().endswith('.csv'))]
+            heartsummeray_files = [file for file in files if is_summary(file)]
 
             for file in heartsummeray_files:
                 file_path = os.path.join(path + "/" + folder_name + "/Fitbit/", file)
@@ -52,6 +63,7 @@ def delete_unused(path):
                     os.remove(file_path)
                     print(f"Deleted file: {file}")
                 except Exception as e:
+                    instrument.failure(file_path, e)
                     print(f"Error deleting file {file}: {e}")
 
 
@@ -74,16 +86,62 @@ def delete_empty(path):
                     shutil.rmtree(path + "/" + folder_name)
                     print(f"Deleted Folder: {folder_name}")
                 except Exception as e:
+                    instrument.failure(path + "/" + folder_name, e)
                     print(f"Error deleting folder: {e}")
 
 
-def run_preprocessing(path):
+def fitbit_files(fitbit_path):
+    """
+           Lists the files of a Fitbit folder the way they are after extract_months and delete_unused,
+           looking inside the month folders and skipping the summary files
+
+           :param fitbit_path: The Fitbit folder of a student
+           :return: list of (filename, file path)
+   """
+    files = []
+    with os.scandir(fitbit_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                files.extend(fitbit_files(entry.path))
+            elif not is_summary(entry.name):
+                files.append((entry.name, entry.path))
+    return files
+
+
+def build_manifest(path):
+    """
+           Finds the files run_preprocessing would keep, without moving or deleting anything.
+           Each student folder is scanned once, and students without csv files are left out like delete_empty would.
+
+           :param path: The directory of all the student files to look through
+           :return: dict of student folder name -> list of (filename, file path) of their Fitbit files
+   """
+    manifest = {}
+    with os.scandir(path) as student_entries:
+        for student_entry in student_entries:
+            if student_entry.name == '.git' or not student_entry.is_dir():
+                continue
+            files = fitbit_files(os.path.join(student_entry.path, "Fitbit"))
+            if any(filename.lower().endswith('.csv') for filename, file_path in files):
+                manifest[student_entry.name] = files
+    return manifest
+
+
+def run_preprocessing(path, virtual=False):
     """
            Run all three methods to only keep students with non-summary csv files in the path
 
            :param path: The directory of all the student files to look through
-           :return: void
+           :param virtual: leave the files where they are and return a manifest of them instead (see build_manifest)
+           :return: the manifest if virtual, otherwise void
    """
-    extract_months(path)
-    delete_unused(path)
-    delete_empty(path)
+    cohort = os.path.basename(path)
+    if virtual:
+        with instrument.stage("build_manifest", cohort=cohort):
+            return build_manifest(path)
+    with instrument.stage("extract_months", cohort=cohort):
+        extract_months(path)
+    with instrument.stage("delete_unused", cohort=cohort):
+        delete_unused(path)
+    with instrument.stage("delete_empty", cohort=cohort):
+        delete_empty(path)
@@ -1,10 +1,28 @@
 import os
+import numpy as np
 import pandas as pd
 from datetime import datetime
-
+from itertools import repeat
+
+import cache
+import frames
+import instrument
+import intraday
+import reader
+import store
 import survey
 from survey import student
 
+# Fitbit features in processing order, with the column range holding their data
+FEATURES = [
+    ("ID", 1, 2),
+    ("step", 1, 2),
+    ("heart", 1, 2),
+    ("distance", 1, 2),
+    ("sleep", 1, 2),
+    ("calories", 2, 3),
+]
+
 
 def get_date(filename):
     """
@@ -22,7 +40,166 @@ def get_date(filename):
     return formatted_date
 
 
-def student(folder_path, feature, l, r, combined_data):
+def index_cohort(folder_path, features=None, manifest=None):
+    """
+               Walks the cohort once and groups every student's Fitbit files by feature and date
+
+               :param folder_path: path of the term folder
+               :param features: feature prefixes to index, defaults to every feature in FEATURES
+               :param manifest: optional result of Preprocess.build_manifest to index instead of the Fitbit folders
+               :return: dict of student -> feature -> date -> list of file paths, in directory order.
+                        Files whose name holds no date are counted as failures of the running stage and left out
+    """
+    if features is None:
+        features = [feature for feature, l, r in FEATURES]
+    if manifest is None:
+        manifest = {}
+        with os.scandir(folder_path) as student_entries:
+            for student_entry in student_entries:
+                if student_entry.is_dir():
+                    with os.scandir(os.path.join(student_entry.path, "Fitbit")) as entries:
+                        manifest[student_entry.name] = [(entry.name, entry.path) for entry in entries]
+    index = {}
+    for student_dir, files in manifest.items():
+        student_files = {feature: {} for feature in features}
+        for filename, file_path in files:
+            if not filename.endswith(".csv"):
+                continue
+            for feature in features:
+                if filename.startswith(feature):
+                    # A stray file without a date in its name is skipped rather than failing the whole cohort
+                    try:
+                        formatted_date = get_date(filename)
+                    except ValueError as e:
+                        instrument.failure(file_path, e)
+                        continue
+                    student_files[feature].setdefault(formatted_date, []).append(file_path)
+        index[student_dir] = student_files
+    return index
+
+
+def aggregate_file(file_path, feature, l, r, statistics=()):
+    """
+               Reduces one intraday file to the daily value of its feature
+
+               :param file_path: path of the csv file
+               :param feature: feature(step, calories, etc.) of which data is being processed
+               :param l left side of the column containing the data
+               :param r right side of column containing the data
+               :param statistics: names of extra statistics to compute from the same read (see intraday.STATISTICS)
+               :return: count of 1s for sleep, mean for heart, sum otherwise,
+                        with statistics a tuple of that value and a dict of the extra statistics
+    """
+    if os.path.getsize(file_path) > reader.MEMORY_LIMIT:
+        # Oversized exports are streamed so they never have to fit in memory at once
+        chunks = reader.iter_columns(file_path, l, r, reader.DTYPES.get(feature))
+        # Only the hourly statistic needs to know where a row falls in the day before the rows are read
+        rows = reader.count_rows(file_path) if "hourly" in statistics else None
+        return aggregate_chunks(chunks, feature, statistics, rows)
+    # Only the data columns are parsed, so the frame holds just columns l to r
+    df = reader.read_columns(file_path, l, r, reader.DTYPES.get(feature))
+    if feature == 'sleep':
+        value = df.eq(1).sum().sum()
+    elif feature == 'heart':
+        value = df.mean().values[0]
+    else:
+        value = df.sum().values[0]
+    if not statistics:
+        return value
+    return value, intraday.compute(df.iloc[:, 0].to_numpy(dtype='float64'), statistics)
+
+
+def aggregate_chunks(chunks, feature, statistics=(), rows=None):
+    """
+               Folds the daily value of a feature over the chunks of one file, giving what aggregate_file
+               gives for the whole file (up to float rounding)
+
+               :param chunks: iterable of dataframes holding the data columns of the file
+               :param feature: feature(step, calories, etc.) of which data is being processed
+               :param statistics: names of extra statistics to fold over the same chunks (see intraday.fold)
+               :param rows: number of rows of the file, needed by the hourly statistic
+               :return: count of 1s for sleep, mean for heart, sum otherwise,
+                        with statistics a tuple of that value and a dict of the extra statistics
+    """
+    total = None
+    count = 0
+    state = intraday.start_fold(statistics, rows) if statistics else None
+    for chunk in chunks:
+        if state is not None:
+            intraday.fold(state, chunk.iloc[:, 0].to_numpy(dtype='float64'))
+        if feature == 'sleep':
+            value = chunk.eq(1).sum().sum()
+        else:
+            value = chunk.iloc[:, 0].sum()
+            count += chunk.iloc[:, 0].count()
+        total = value if total is None else total + value
+    if feature == 'heart':
+        total = total / count if count else np.nan
+    if state is None:
+        return total
+    return total, intraday.fold_result(state)
+
+
+def aggregate_student(feature_files, feature, l, r, cached=None, statistics=()):
+    """
+               Reduces all of one student's files for a feature to their daily values.
+               Files that cannot be read are skipped and counted as failures of the running stage.
+
+               :param feature_files: date -> list of file paths, one feature of a student in index_cohort
+               :param feature: feature(step, calories, etc.) of which data is being processed
+               :param l left side of the column containing the data
+               :param r right side of column containing the data
+               :param cached: optional dict of file path -> daily value for files that need no parsing
+               :param statistics: names of extra statistics to compute (see aggregate_file)
+               :return: list of (date, file path, daily value)
+    """
+    records = []
+    for formatted_date, file_paths in feature_files.items():
+        for file_path in file_paths:
+            if cached and file_path in cached:
+                records.append((formatted_date, file_path, cached[file_path]))
+                continue
+            try:
+                records.append((formatted_date, file_path, aggregate_file(file_path, feature, l, r, statistics)))
+            except Exception as e:
+                instrument.failure(file_path, e)
+    return records
+
+
+def store_student(minute_store, feature_files, feature, l, r, ID, statistics=()):
+    """
+               Reduces one student's days from the minute store, parsing the files of the days the store does not hold
+
+               :param minute_store: store from store.open_store
+               :param feature_files: date -> list of file paths, one feature of a student in index_cohort
+               :param feature: feature(step, calories, etc.) of which data is being processed
+               :param l left side of the column containing the data
+               :param r right side of column containing the data
+               :param ID: student folder name
+               :param statistics: names of extra statistics to compute (see aggregate_file)
+               :return: list of (date, file path or None, daily value), like aggregate_student
+    """
+    # Days the store has but the cohort no longer has are left out
+    records = [record for record in store.records(minute_store, feature, ID, statistics)
+               if record[0] in feature_files]
+    held = {record[0] for record in records}
+    missing = {date: file_paths for date, file_paths in feature_files.items() if date not in held}
+    if missing:
+        records += aggregate_student(missing, feature, l, r, None, statistics)
+    return records
+
+
+def aggregate_student_counted(feature_files, feature, l, r, cached=None, statistics=()):
+    """
+               Runs aggregate_student in a pool worker and hands back what it read
+
+               :return: tuple of the result of aggregate_student and the counts from instrument.collect
+    """
+    return aggregate_student(feature_files, feature, l, r, cached, statistics), instrument.collect()
+
+
+def student(folder_path, feature, l, r, combined_data, index=None, executor=None, aggregate_cache=None,
+            statistics=(), minute_store=None):
     """
                Runs all to get one term concatenated information on one feature
 
@@ -31,47 +208,67 @@ def student(folder_path, feature, l, r, combined_data):
                :param l left side of the column containing the data
                :param r right side of column containing the data
                :param combined_data data frame to put information in
+               :param index: result of index_cohort for the term, built here if not given
+               :param executor: optional concurrent.futures executor to parse the students on
+               :param aggregate_cache: optional cache from cache.load, only files missing from it are parsed
+               :param statistics: names of extra statistics to add as <feature>_<statistic>_<ID> columns
+               :param minute_store: optional store from store.open_store, reduced instead of parsing the files
                :return: dataframe containing concatenation of given feature for given student
     """
-    # Iterate through all files in the folder
-    for student_dir in os.listdir(folder_path):
-        ID = student_dir
-        student_dir_path = os.path.join(folder_path, student_dir)
-        if os.path.isdir(student_dir_path):
-            # Initialize an empty DataFrame for the current student
-            student_data = {'Date': [], 'Sums': []}
-            # Iterate through all CSV files in the student directory
-            fitbit_path = os.path.join(student_dir_path, "Fitbit")
-            for filename in os.listdir(fitbit_path):
-                if filename.startswith(feature) and filename.endswith(".csv"):
-                    file_path = os.path.join(fitbit_path, filename)
-                    # Read each CSV file into a DataFrame
-                    df = pd.read_csv(file_path)
-                    formatted_date = get_date(filename)
-                    student_data['Date'].append(formatted_date)
-                    # Add another column 'Sums' with the sum of specific columns from df
-                    if feature == 'sleep':
-                        column_sum = df.iloc[:, l:r].eq(1).sum().sum()
-                        student_data['Sums'].append(column_sum)
-                    elif feature == 'heart':
-                        student_data['Sums'].append(df.iloc[:, l:r].mean().values[0])
-                    else:
-                        student_data['Sums'].append(df.iloc[:, l:r].sum().values[0])
-
-
-            # Create a DataFrame for the current student
-            student_df = pd.DataFrame(student_data)
-            student_df = student_df.rename(columns={'Sums': feature + "_" + ID})
-            # Merge the student DataFrame with the combined data on the 'Date' column
-            if combined_data.empty:
-                combined_data = student_df
-            else:
-                combined_data = pd.merge(combined_data, student_df, on=['Date'], how='outer',
-                                         suffixes=('', f'_{student_dir}'))
-    return combined_data
-
-
-def combine_student_data(folder_path, output_file_path, feature, l, r):
+    if index is None:
+        index = index_cohort(folder_path, [feature])
+    # Collect every student's (Date, value) records, then build the wide layout once
+    students = list(index)
+    feature_files = [index[ID][feature] for ID in students]
+    cached = [None] * len(students)
+    signatures = {}
+    from_store = minute_store is not None and feature in minute_store["features"]
+    if from_store:
+        # No file is parsed, so there is nothing to cache either
+        aggregate_cache = None
+    if aggregate_cache is not None:
+        key = cache.aggregate_key(feature, l, r)
+        if statistics:
+            key += ":" + ",".join(statistics)
+        for i, files in enumerate(feature_files):
+            cached[i] = {}
+            for file_paths in files.values():
+                for file_path in file_paths:
+                    signatures[file_path] = cache.signature(aggregate_cache, file_path)
+                    value = cache.get(aggregate_cache, file_path, signatures[file_path], key)
+                    if value is not cache.MISSING:
+                        cached[i][file_path] = value
+    if from_store:
+        results = [store_student(minute_store, files, feature, l, r, ID, statistics)
+                   for ID, files in zip(students, feature_files)]
+    elif executor is None:
+        results = [aggregate_student(files, feature, l, r, hits, statistics)
+                   for files, hits in zip(feature_files, cached)]
+    else:
+        # map keeps the student order, so the output does not depend on which worker finishes first
+        results = []
+        for records, counts in executor.map(aggregate_student_counted, feature_files, repeat(feature), repeat(l),
+                                            repeat(r), cached, repeat(statistics)):
+            instrument.merge(counts)
+            results.append(records)
+    columns = {}
+    for ID, hits, records in zip(students, cached, results):
+        if aggregate_cache is not None:
+            for formatted_date, file_path, value in records:
+                if file_path not in hits:
+                    cache.put(aggregate_cache, file_path, signatures[file_path], key, value)
+        dates = [record[0] for record in records]
+        if not statistics:
+            columns[feature + "_" + ID] = (dates, [record[2] for record in records])
+            continue
+        columns[feature + "_" + ID] = (dates, [record[2][0] for record in records])
+        for name in intraday.column_names(statistics):
+            columns[feature + "_" + name + "_" + ID] = (dates, [record[2][1][name] for record in records])
+    return frames.widen(combined_data, columns)
+
+
+def combine_student_data(folder_path, output_file_path, feature, l, r, index=None, executor=None,
+                         aggregate_cache=None, statistics=(), minute_store=None):
     """
                Runs all the main code for getting all the information from the term of one feature and adding it to the term CSV
 
@@ -81,6 +278,11 @@ def combine_student_data(folder_path, output_file_path, feature, l, r):
                :param feature: feature(step, calories, etc.) of which data is being processed
                :param l left side of the column containing the data
                :param r right side of column containing the data
+               :param index: result of index_cohort for the term, built here if not given
+               :param executor: optional concurrent.futures executor to parse the students on
+               :param aggregate_cache: optional cache from cache.load, only files missing from it are parsed
+               :param statistics: names of extra statistics to add as <feature>_<statistic>_<ID> columns
+               :param minute_store: optional store from store.open_store, reduced instead of parsing the files
                :return: void
     """
     try:
@@ -89,33 +291,36 @@ def combine_student_data(folder_path, output_file_path, feature, l, r):
         if not os.path.exists(output_directory):
             os.makedirs(output_directory)
         if os.path.exists(output_file_path):
-            combined_data = pd.read_csv(output_file_path)
+            combined_data = frames.read_frame(output_file_path)
+            # Parquet keeps the dates parsed, the students' dates are text like in the csv
+            if pd.api.types.is_datetime64_any_dtype(combined_data['Date']):
+                combined_data['Date'] = combined_data['Date'].dt.strftime('%Y-%m-%d')
         else:
             combined_data = pd.DataFrame()
 
-        combined_data = student(folder_path, feature, l, r, combined_data)
+        combined_data = student(folder_path, feature, l, r, combined_data, index, executor, aggregate_cache,
+                                statistics, minute_store)
 
         # Sort the 'Date' column in ascending order
         combined_data['Date'] = pd.to_datetime(combined_data['Date'], format='%Y-%m-%d')
         combined_data = combined_data.sort_values(by='Date')
 
         # Write the combined data to a CSV file
-        combined_data.to_csv(output_file_path, index=False)
+        frames.write_frame(combined_data, output_file_path)
 
     except Exception as e:
+        instrument.failure(output_file_path, e)
         print(f"Error combining student data: {e}")
 
 
-def reformat(output_file_path):
+def reorder(df):
     """
-           Reformats the CSV file of all the data to have the all 5 files of the student next to each other.
-           Adds in two rows, the first containing just the ID of the student and the second containing just the feature of that column
+           Rearranges the term data frame so all the columns of a student are next to each other,
+           and replaces the dates by the day number
 
-           :param output_file_path: path to export the csv to
-           :return: void
+           :param df: data frame of the term
+           :return: rearranged data frame
     """
-    df = pd.read_csv(output_file_path)
-
     # Group columns by their suffixes
     df["Date"] = range(1, len(df) + 1)
     grouped_columns = {}
@@ -128,36 +333,102 @@ def reformat(output_file_path):
                 grouped_columns[suffix] = []
             grouped_columns[suffix].append(col)
 
-    # Combine the grouped columns
-    new_order = [col for suffix in grouped_columns.values() for col in suffix]
+    # Combine the grouped columns, with the extra statistics after each student's daily values
+    # so the columns following a step column are still the student's other features
+    new_order = [col for suffix in grouped_columns.values()
+                 for col in sorted(suffix, key=lambda col: col != "Date" and intraday.is_extra(col.rsplit('_', 1)[0]))]
 
     # Create a new DataFrame with the rearranged columns
-    df_rearranged = df[new_order]
+    return df[new_order]
+
+
+def reformat(output_file_path, compact=False):
+    """
+           Reformats the CSV file of all the data to have the all 5 files of the student next to each other.
+           Adds in two rows, the first containing just the ID of the student and the second containing just the feature of that column
+
+           :param output_file_path: path to export the csv to
+           :param compact: store the file in compact types (see frames.compact)
+           :return: void
+    """
+    df = frames.read_frame(output_file_path)
 
-    # Save the new DataFrame to a new CSV file
-    df_rearranged.to_csv(output_file_path, index=False)
+    df_rearranged = reorder(df)
+    if compact:
+        df_rearranged = frames.compact(df_rearranged.copy())
+
+    # Save the new DataFrame to a new file in the format of its extension
+    frames.write_frame(df_rearranged, output_file_path)
 
 
     print(output_file_path + " created")
 
 
-def run_all(folder_path, output_file_path):
+def run_all(folder_path, output_file_path, in_memory=False, executor=None, aggregate_cache=None, manifest=None,
+            compact=False, statistics=None, store_path=None, survey_join='merge'):
     """
                Runs all methods to export csv files for each cohort
 
                :param folder_path: path of the cohort
-               :param output_file_path: path to export the csv to
+               :param output_file_path: path to export the csv to, written as Parquet if it ends in .parquet
+               :param in_memory: keep the cohort in one data frame and write it once at the end,
+                                 instead of writing and re-reading the file after every feature
+               :param executor: optional concurrent.futures executor to parse the students on
+               :param aggregate_cache: optional cache from cache.load, only files missing from it are parsed
+               :param manifest: result of Preprocess.run_preprocessing(virtual=True), read instead of the folders
+               :param compact: store the cohort file in compact types (see frames.compact), kept as such in Parquet
+               :param statistics: optional dict of feature -> names of extra statistics (see intraday.EXTRA_STATISTICS)
+               :param store_path: optional folder of a store of the minute values (see store), built from the files
+                                  the first time and whenever they change, the daily values are then reduced
+                                  from it instead of parsed
+               :param survey_join: 'merge' adds a row per survey submission, 'asof' gives every day the answers
+                                   of the next submission (see survey.add_surveys)
                :return: void
     """
-    combine_student_data(folder_path, output_file_path, "ID", 1, 2)
-    combine_student_data(folder_path, output_file_path, "step", 1, 2)
-    combine_student_data(folder_path, output_file_path, "heart", 1, 2)
-    combine_student_data(folder_path, output_file_path, "distance", 1, 2)
-    combine_student_data(folder_path, output_file_path, "sleep", 1, 2)
-    combine_student_data(folder_path, output_file_path, "calories", 2, 3)
-    survey.student(folder_path, output_file_path)
-
-    reformat(output_file_path)
-
-
+    cohort = os.path.basename(folder_path)
+    # List the cohort once and share the file groups between all feature passes
+    with instrument.stage("index", cohort=cohort):
+        index = index_cohort(folder_path, manifest=manifest)
+    students = list(manifest) if manifest is not None else None
+    if statistics is None:
+        statistics = {}
+    minute_store = None
+    if store_path:
+        stored_features = [(feature, l, r) for feature, l, r in FEATURES if feature != "ID"]
+        # Rebuilt whenever a file was added, removed or changed since the store was written
+        if not store.is_current(store_path, index, stored_features):
+            with instrument.stage("store", cohort=cohort):
+                store.build(store_path, index, stored_features)
+        minute_store = store.open_store(store_path)
+    if not in_memory:
+        for feature, l, r in FEATURES:
+            with instrument.stage("feature", cohort=cohort, feature=feature):
+                combine_student_data(folder_path, output_file_path, feature, l, r, index, executor, aggregate_cache,
+                                     statistics.get(feature, ()), minute_store)
+        with instrument.stage("survey", cohort=cohort):
+            survey.student(folder_path, output_file_path, executor, students, survey_join)
+        with instrument.stage("reformat", cohort=cohort):
+            reformat(output_file_path, compact)
+        return
+
+    combined_data = pd.DataFrame()
+    for feature, l, r in FEATURES:
+        with instrument.stage("feature", cohort=cohort, feature=feature):
+            try:
+                combined_data = student(folder_path, feature, l, r, combined_data, index, executor, aggregate_cache,
+                                        statistics.get(feature, ()), minute_store)
+            except Exception as e:
+                instrument.failure(folder_path, e)
+                print(f"Error combining student data: {e}")
+    with instrument.stage("survey", cohort=cohort):
+        combined_data = survey.add_surveys(folder_path, combined_data, executor, students, survey_join)
+    with instrument.stage("reformat", cohort=cohort):
+        combined_data = reorder(combined_data)
+        if compact:
+            combined_data = frames.compact(combined_data.copy())
 
+        output_directory = os.path.dirname(output_file_path)
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        frames.write_frame(combined_data, output_file_path)
+    print(output_file_path + " created")
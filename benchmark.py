@@ -0,0 +1,111 @@
+# Times every stage of the pipeline on synthetic cohorts of several sizes
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+import dataset
+import imputation
+import main
+import synthetic
+from Preprocess import run_preprocessing
+from Process import run_all
+
+
+def run_scale(root, cohorts, students, days, rows, in_memory=False, virtual=False, workers=1):
+    """
+    Generates one synthetic data folder and times every stage on it
+
+    :param root: data folder to create, deleted first if it exists
+    :param cohorts: number of cohorts
+    :param students: students per cohort
+    :param days: days of data per student
+    :param rows: rows per intraday file
+    :param in_memory: run Process.run_all in its in-memory mode
+    :param virtual: preprocess with a manifest instead of moving and deleting files
+    :param workers: processes to parse the students on, 1 for serial
+    :return: dict of stage name -> seconds, with the scale parameters
+    """
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cohort_paths = synthetic.generate(root, cohorts, students, days, rows)
+    timings = {"cohorts": cohorts, "students": students, "days": days, "rows": rows}
+
+    executor = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        start = time.perf_counter()
+        manifests = [run_preprocessing(cohort_path, virtual) for cohort_path in cohort_paths]
+        timings["run_preprocessing"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for cohort_path, manifest in zip(cohort_paths, manifests):
+            run_all(cohort_path, cohort_path + ".csv", in_memory, executor, None, manifest)
+        timings["run_all"] = time.perf_counter() - start
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    start = time.perf_counter()
+    main.combine(root)
+    timings["combine"] = time.perf_counter() - start
+
+    dataset_path = os.path.join(root, "dataset")
+    start = time.perf_counter()
+    for cohort_path in cohort_paths:
+        dataset.write_cohort(dataset_path, os.path.basename(cohort_path), pd.read_csv(cohort_path + ".csv"))
+    timings["dataset_write"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # The default query reads every partition, so it also checks that the dataset can be read back
+    if dataset.load(dataset_path).empty:
+        raise RuntimeError("dataset.load returned no rows for " + dataset_path)
+    timings["dataset_load"] = time.perf_counter() - start
+
+    df = pd.read_csv(os.path.join(root, "all.csv"))
+    start = time.perf_counter()
+    imputation.impute(df)
+    timings["impute"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    imputation.reshape(df)
+    timings["reshape"] = time.perf_counter() - start
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic data")
+    parser.add_argument("--scales", default="5x7,20x14,50x28",
+                        help="comma separated STUDENTSxDAYS sizes, each run per cohort")
+    parser.add_argument("--cohorts", type=int, default=2)
+    parser.add_argument("--rows", type=int, default=1440, help="rows per intraday file")
+    parser.add_argument("--in-memory", action="store_true")
+    parser.add_argument("--virtual", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--root", help="folder to generate the data in, a temporary folder by default")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    base = args.root or tempfile.mkdtemp(prefix="mqp_benchmark_")
+    results = []
+    try:
+        for scale in args.scales.split(","):
+            students, days = (int(n) for n in scale.lower().split("x"))
+            timings = run_scale(os.path.join(base, scale), args.cohorts, students, days, args.rows,
+                                args.in_memory, args.virtual, args.workers)
+            results.append(timings)
+            print(", ".join(f"{key}={value:.3f}s" if isinstance(value, float) else f"{key}={value}"
+                            for key, value in timings.items()))
+    finally:
+        if not args.root:
+            shutil.rmtree(base)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
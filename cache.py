@@ -0,0 +1,119 @@
+# Persistent cache of the daily value computed from each intraday file, so reruns only parse new or changed files
+
+import hashlib
+import json
+import os
+
+MISSING = object()
+
+
+def load(cache_path, content_hash=False):
+    """
+    Loads the cache file, or starts an empty cache if there is none yet
+
+    :param cache_path: path of the json cache file
+    :param content_hash: also compare a sha1 of the file contents, not only its size and mtime
+    :return: cache dict to pass to get and put
+    """
+    files = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            files = json.load(f)["files"]
+    return {"content_hash": content_hash, "files": files}
+
+
+def save(cache, cache_path):
+    """
+    Evicts entries of files that no longer exist and writes the cache file
+
+    :param cache: cache dict from load
+    :param cache_path: path of the json cache file
+    :return: void
+    """
+    files = cache["files"]
+    for file_path in [file_path for file_path in files if not os.path.exists(file_path)]:
+        del files[file_path]
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(temp_path, cache_path)
+
+
+def signature(cache, file_path):
+    """
+    Describes the current version of a file
+
+    :param cache: cache dict from load
+    :param file_path: path of the file
+    :return: list of the size, the mtime in nanoseconds and the sha1 of the contents (None unless hashing)
+    """
+    stat = os.stat(file_path)
+    digest = None
+    if cache["content_hash"]:
+        with open(file_path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    return [stat.st_size, stat.st_mtime_ns, digest]
+
+
+def aggregate_key(feature, l, r):
+    """
+    Key of one aggregate of a file
+
+    :param feature: feature(step, calories, etc.) of which data is being processed
+    :param l left side of the column containing the data
+    :param r right side of column containing the data
+    :return: string key
+    """
+    return f"{feature}:{l}:{r}"
+
+
+def get(cache, file_path, file_signature, key):
+    """
+    Looks up an aggregate of a file, dropping the file's entry if the file has changed
+
+    :param cache: cache dict from load
+    :param file_path: path of the file
+    :param file_signature: result of signature for the file
+    :param key: result of aggregate_key
+    :return: the cached value, or MISSING
+    """
+    entry = cache["files"].get(file_path)
+    if entry is None:
+        return MISSING
+    if not _matches(entry["signature"], file_signature):
+        del cache["files"][file_path]
+        return MISSING
+    return entry["values"].get(key, MISSING)
+
+
+def put(cache, file_path, file_signature, key, value):
+    """
+    Stores an aggregate of a file
+
+    :param cache: cache dict from load
+    :param file_path: path of the file
+    :param file_signature: result of signature for the file
+    :param key: result of aggregate_key
+    :param value: the aggregate, or a tuple of it and a dict of extra statistics,
+                  numpy scalars are stored as the equivalent python value
+    :return: void
+    """
+    entry = cache["files"].get(file_path)
+    if entry is None or not _matches(entry["signature"], file_signature):
+        entry = cache["files"][file_path] = {"signature": file_signature, "values": {}}
+    if isinstance(value, tuple):
+        value = [value[0].item() if hasattr(value[0], "item") else value[0], value[1]]
+    elif hasattr(value, "item"):
+        value = value.item()
+    entry["values"][key] = value
+
+
+def _matches(stored, current):
+    """
+    Compares two signatures, the content hash only counts when the current one has it
+
+    :param stored: signature saved in the cache
+    :param current: signature of the file now
+    :return: True if the file is unchanged
+    """
+    return stored[:2] == current[:2] and (current[2] is None or stored[2] == current[2])
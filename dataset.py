@@ -0,0 +1,190 @@
+# Dataset partitioned by cohort and student, so a job on one student or a few days only reads that student's file
+
+import json
+import os
+
+import pandas as pd
+
+import frames
+import reader
+
+# Name of the file listing every partition with the days it covers, kept in the dataset folder
+INDEX_FILE = "index.json"
+
+# Partitions are Parquet when pyarrow is installed, so single columns can be read without parsing the rest
+FORMAT = "parquet" if reader.pyarrow is not None else "csv"
+
+# Name the Fitbit ID feature is stored under, so it does not clash with the 'ID' column load adds
+ID_FEATURE = "fitbit_ID"
+
+
+def load_index(root):
+    """
+    Loads the index of a dataset, or starts an empty index if there is none yet
+
+    :param root: the dataset folder
+    :return: dict of cohort -> student ID -> {"file", "start", "end", "rows", "features"},
+             a student in several cohorts has an entry in each of them
+    """
+    index_path = os.path.join(root, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        index = json.load(f)
+    if any("file" in entry for entry in index.values()):
+        # Older indexes were keyed by student ID only, with the cohort inside the entry
+        nested = {}
+        for student_id, entry in index.items():
+            nested.setdefault(entry.pop("cohort"), {})[student_id] = entry
+        index = nested
+    return index
+
+
+def save_index(root, index):
+    """
+    Writes the index of a dataset
+
+    :param root: the dataset folder
+    :param index: dict from load_index
+    :return: void
+    """
+    index_path = os.path.join(root, INDEX_FILE)
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(temp_path, index_path)
+
+
+def split_students(df):
+    """
+    Splits a wide table into one table per student, with the ID suffix taken off the column names
+
+    :param df: data frame with a 'Date' column and <feature>_<ID> columns, like all.csv
+    :return: dict of student ID -> data frame with a 'Date' column and one column per feature,
+             holding only the days the student has any data, the Fitbit ID feature named ID_FEATURE
+    """
+    columns = {}
+    for col in df.columns:
+        if col != 'Date' and '_' in col:
+            feature, student_id = col.rsplit('_', 1)
+            columns.setdefault(student_id, {})[col] = ID_FEATURE if feature == 'ID' else feature
+    students = {}
+    for student_id, names in columns.items():
+        student_df = df[['Date'] + list(names)].rename(columns=names)
+        student_df = student_df.dropna(how='all', subset=list(names.values()))
+        students[student_id] = student_df.sort_values(by='Date').reset_index(drop=True)
+    return students
+
+
+def write_cohort(root, cohort, df):
+    """
+    Writes one partition per student of a cohort and replaces the cohort's entries in the index,
+    the partitions the same students have in other cohorts are kept
+
+    :param root: the dataset folder
+    :param cohort: name of the cohort
+    :param df: wide data frame of the cohort, with a 'Date' column of day numbers
+    :return: void
+    """
+    os.makedirs(os.path.join(root, cohort), exist_ok=True)
+    index = load_index(root)
+    entries = {}
+    for student_id, student_df in split_students(df).items():
+        file = os.path.join(cohort, student_id + "." + FORMAT)
+        frames.write_frame(student_df, os.path.join(root, file))
+        dates = student_df['Date']
+        entries[student_id] = {"file": file,
+                               "start": int(dates.min()) if len(dates) else None,
+                               "end": int(dates.max()) if len(dates) else None,
+                               "rows": len(student_df), "features": list(student_df.columns[1:])}
+    index[cohort] = entries
+    save_index(root, index)
+
+
+def write(root, df, cohorts=None):
+    """
+    Writes a wide table of several cohorts, like filled.csv
+
+    :param root: the dataset folder
+    :param df: wide data frame with a 'Date' column of day numbers
+    :param cohorts: optional dict of student ID -> list of cohorts, like cohorts() of the combined dataset.
+                    A student in several cohorts has plain columns for the first one and columns with the
+                    _<cohort> suffix main.combine gives them for the others. Students missing from it go to
+                    the cohort 'all'
+    :return: void
+    """
+    if cohorts is None:
+        cohorts = {}
+    groups = {}
+    for col in df.columns:
+        if col == 'Date' or '_' not in col:
+            continue
+        head, suffix = col.rsplit('_', 1)
+        if '_' in head and suffix in cohorts.get(head.rsplit('_', 1)[1], ()):
+            groups.setdefault(suffix, {})[col] = head
+        else:
+            student_cohorts = cohorts.get(suffix)
+            groups.setdefault(student_cohorts[0] if student_cohorts else "all", {})[col] = col
+    for cohort, names in groups.items():
+        write_cohort(root, cohort, df[['Date'] + list(names)].rename(columns=names))
+
+
+def cohorts(root):
+    """
+    :param root: the dataset folder
+    :return: dict of student ID -> list of the cohorts the student has a partition in, in index order
+    """
+    student_cohorts = {}
+    for cohort, entries in load_index(root).items():
+        for student_id in entries:
+            student_cohorts.setdefault(student_id, []).append(cohort)
+    return student_cohorts
+
+
+def load(root, student_ids=None, start=None, end=None, features=None, cohorts=None):
+    """
+    Reads the days and features asked for, opening only the partitions of the students whose days overlap them
+
+    :param root: the dataset folder
+    :param student_ids: optional list of student IDs, all students by default
+    :param start: optional first day number to return
+    :param end: optional last day number to return
+    :param features: optional list of features to return, all of them by default,
+                     'ID' asks for the Fitbit ID feature, returned as the ID_FEATURE column
+    :param cohorts: optional list of cohorts to read the students from, all cohorts by default
+    :return: data frame with 'ID', 'cohort' and 'Date' columns followed by the features, one row per
+             student, cohort and day
+    """
+    index = load_index(root)
+    if features is not None:
+        features = [ID_FEATURE if feature == 'ID' else feature for feature in features]
+    if cohorts is not None:
+        index = {cohort: index[cohort] for cohort in cohorts if cohort in index}
+    if student_ids is None:
+        student_ids = list(dict.fromkeys(student_id for entries in index.values() for student_id in entries))
+    parts = []
+    for student_id in student_ids:
+        for cohort, entries in index.items():
+            entry = entries.get(str(student_id))
+            if entry is None or not entry["rows"]:
+                continue
+            if (start is not None and entry["end"] < start) or (end is not None and entry["start"] > end):
+                continue
+            columns = None
+            if features is not None:
+                columns = ['Date'] + [feature for feature in features if feature in entry["features"]]
+            student_df = frames.read_frame(os.path.join(root, entry["file"]), columns=columns)
+            if start is not None:
+                student_df = student_df[student_df['Date'] >= start]
+            if end is not None:
+                student_df = student_df[student_df['Date'] <= end]
+            student_df.insert(0, 'ID', str(student_id))
+            student_df.insert(1, 'cohort', cohort)
+            parts.append(student_df)
+    if not parts:
+        return pd.DataFrame(columns=['ID', 'cohort', 'Date'] + list(features or []))
+    df = pd.concat(parts, ignore_index=True)
+    if features is not None:
+        # Features a student does not have come back as NaN
+        df = df.reindex(columns=['ID', 'cohort', 'Date'] + list(features))
+    return df
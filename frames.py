@@ -0,0 +1,159 @@
+# Helpers for building and storing the wide cohort tables
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import instrument
+import reader
+
+try:
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:  # only needed for Parquet files
+    pyarrow_parquet = None
+
+# Columns of these features hold Fitbit aggregates and are stored as float32 by compact,
+# the other numeric columns are survey answers and get the smallest integer type that holds them
+FLOAT_FEATURES = tuple(reader.DTYPES)
+
+
+def widen(combined_data, columns):
+    """
+    Builds the wide layout of one pass from per-student records with a single concat,
+    then outer-joins it onto the data collected so far with a single merge on 'Date'.
+
+    :param combined_data: data frame to put information in
+    :param columns: dict of column name -> (dates, values), in the order the columns should appear
+    :return: dataframe containing combined_data and one column per entry of columns
+    """
+    names = list(columns)
+    if combined_data.empty:
+        # An empty frame used to be replaced by the first student rather than merged,
+        # so students before the first one with data contribute no column
+        filled = [name for name in names if len(columns[name][0])]
+        if not filled:
+            return pd.DataFrame({'Date': [], names[-1]: []}) if names else combined_data
+        names = names[names.index(filled[0]):]
+
+    series = {}
+    for name in names:
+        dates, values = columns[name]
+        if len(dates):
+            column = pd.Series(list(values), index=pd.Index(list(dates), name='Date'))
+            column = column[~column.index.duplicated(keep='last')]
+        else:
+            column = pd.Series([], index=pd.Index([], name='Date'), dtype='float64')
+        # Columns already in the frame get the student suffix the per-student merges used to add
+        if name in combined_data.columns:
+            name = name + "_" + name.rsplit('_', 1)[1]
+        series[name] = column
+
+    wide = pd.concat(series, axis=1).sort_index()
+    wide.index.name = 'Date'
+    wide = wide.reset_index()
+    if combined_data.empty:
+        return wide
+    return pd.merge(combined_data, wide, on='Date', how='outer')
+
+
+def compact(df, float_features=FLOAT_FEATURES):
+    """
+    Stores a table in the smallest types that hold it: float32 for the Fitbit aggregates, nullable
+    8/16/32 bit integers for whole-number answers, a categorical 'ID' and a datetime64 'Date' when
+    the dates are text (the day numbers of all.csv stay integers)
+
+    :param df: dataframe to convert, changed in place
+    :param float_features: features whose columns are always float32, matched on the name up to the first '_',
+                           so extra statistics and the cohort-suffixed columns of main.combine are included
+    :return: df
+    """
+    for position, col in enumerate(df.columns):
+        column = df.iloc[:, position]
+        if col == 'ID':
+            column = column.astype('category')
+        elif col == 'Date':
+            if column.dtype == object:
+                column = pd.to_datetime(column)
+            elif pd.api.types.is_integer_dtype(column):
+                column = pd.to_numeric(column, downcast='integer')
+        elif not pd.api.types.is_numeric_dtype(column):
+            continue
+        elif col.split('_', 1)[0] in float_features:
+            column = column.astype('float32')
+        else:
+            values = column.dropna().to_numpy(dtype='float64')
+            if len(values) and (values == np.round(values)).all():
+                for dtype in ('Int8', 'Int16', 'Int32'):
+                    info = np.iinfo(dtype.lower())
+                    if info.min <= values.min() and values.max() <= info.max:
+                        column = column.astype(dtype)
+                        break
+            else:
+                column = column.astype('float32')
+        df.isetitem(position, column)
+    return df
+
+
+def read_frame(file_path, compact_types=False, columns=None):
+    """
+    Reads a table written by write_frame
+
+    :param file_path: path of a .parquet or .csv file
+    :param compact_types: load the table in the types of compact, csv values are parsed straight into float32
+    :param columns: optional list of the columns to read, the others are not parsed
+    :return: dataframe
+    """
+    if file_path.lower().endswith('.parquet'):
+        df = pd.read_parquet(file_path, columns=columns)
+    elif compact_types:
+        # Parsing into float32 avoids holding the whole table as float64 first
+        header = pd.read_csv(file_path, nrows=0).columns
+        dtype = {col: 'float32' for col in header if col not in ('ID', 'Date')}
+        if 'ID' in header:
+            dtype['ID'] = 'category'
+        df = pd.read_csv(file_path, dtype=dtype, usecols=columns)
+    else:
+        df = pd.read_csv(file_path, usecols=columns)
+    instrument.count(files=1, bytes_read=os.path.getsize(file_path), rows=len(df))
+    return compact(df) if compact_types else df
+
+
+def iter_frame(file_path, dtype=None, memory_limit=None):
+    """
+    Reads a table written by write_frame in pieces, one row group of a Parquet file
+    or as many csv rows as fit in the memory ceiling at a time
+
+    :param file_path: path of a .parquet or .csv file
+    :param dtype: optional dict of column -> dtype to read the columns as
+    :param memory_limit: bytes a csv chunk may take, defaults to reader.MEMORY_LIMIT
+    :return: generator of dataframes, in the order of the rows in the file
+    """
+    instrument.count(files=1, bytes_read=os.path.getsize(file_path))
+    if file_path.lower().endswith('.parquet'):
+        parquet_file = pyarrow_parquet.ParquetFile(file_path)
+        for i in range(parquet_file.num_row_groups):
+            df = parquet_file.read_row_group(i).to_pandas()
+            instrument.count(rows=len(df))
+            yield df.astype(dtype) if dtype else df
+        return
+    header = pd.read_csv(file_path, nrows=0).columns
+    rows = reader.chunk_rows(file_path, 0, len(header), memory_limit or reader.MEMORY_LIMIT)
+    with pd.read_csv(file_path, dtype=dtype, chunksize=rows) as chunks:
+        for df in chunks:
+            instrument.count(rows=len(df))
+            yield df
+
+
+def write_frame(df, file_path):
+    """
+    Writes a table as Parquet when the path ends in .parquet, as CSV otherwise
+
+    :param df: dataframe to write
+    :param file_path: path to write to
+    :return: void
+    """
+    if file_path.lower().endswith('.parquet'):
+        df.to_parquet(file_path, index=False)
+    else:
+        df.to_csv(file_path, index=False)
@@ -1,109 +1,166 @@
 import pandas as pd
 import numpy as np
 
-# Get the columns that start with "CESD"
-df = pd.read_csv("/Users/oliviaraisbeck/Downloads/MQP/all.csv") #change to your file location
-
-#SURVEY IMPUTATION
-cesd_columns = [col for col in df.columns if col.startswith('CESD')]
-stai_columns = [col for col in df.columns if col.startswith('STAI')]
-
-# Apply forward fill for each CESD column
-for cesd_column in cesd_columns:
-    df[cesd_column] = df[cesd_column].fillna(method='bfill')
-    mask = ~df[cesd_column].isnull()
-    #df[cesd_column] = np.where(df[cesd_column] < 10, 0, 1)
-
-for stai_column in stai_columns:
-    df[stai_column] = df[stai_column].fillna(method='bfill')
-    mask = ~df[stai_column].isnull()
-    #df[stai_column] = np.where(df[stai_column] < 40, 0, 1)
-
-prefixes = ['ThermalSens', 'TempSatisf', 'ThermEnh/Int', 'AirSatisf_1', 'OutdoorAirAmount_1', 'AirEnh/Int_1', 'LightSatisf_1', 'LightSatisf_2', 'LightAmount_1', 'LightEnh/Int_1', 'NoiseSatisf_1', 'NoiseEnh/Int_1', 'EnvSatisf_1', 'LearnIncr/Decr_1', 'CPUSpeed_1', 'InternetSpeed_1', 'DownloadSpeed', 'UploadSpeed']
-
-survey_columns = [col for col in df.columns if any(col.startswith(prefix) for prefix in prefixes)]
-for col in survey_columns:
-    df[col] = df[col].fillna(method='bfill')
-
-#TAKING OUT DATA
-step_columns = [col for col in df.columns if col.startswith('step_')]
-
-# Iterate through each 'step_' column
-for step_col in step_columns:
-    # Find rows where the 'step_' column is 0
-    zero_step_rows = df[df[step_col] < 250].index
-
-    # Set 'step_' and the next 4 columns to NaN for those rows
-    for row in zero_step_rows:
-        df.loc[row, step_col:df.columns[df.columns.get_loc(step_col) + 4]] = np.nan
-
-columns_to_impute = df.columns[df.columns.str.startswith(('step', 'heart', 'distance', 'sleep', 'calories'))]
-
-# Iterate through each column and impute NaN values with the average of that column
-for col in columns_to_impute:
-    # Find indices of non-NaN values in the column
-    non_nan_rows = df[col].notna()
-
-    # Find the first and last non-NaN index in the column
-    first_non_nan = non_nan_rows.idxmax()
-    last_non_nan = non_nan_rows[::-1].idxmax()
-
-    col_avg = df[col].mean()
-
-    # If there are NaN values in the column, impute only within the range
-    if first_non_nan and last_non_nan:
-        df.loc[first_non_nan:last_non_nan, col] = df.loc[first_non_nan:last_non_nan, col].fillna(col_avg)
-
-    #df[col] = df[col] / col_avg
-
-df.to_csv("/Users/oliviaraisbeck/Downloads/MQP/filled.csv")
-
-#REFORMAT INTO 6 ROWS
-new_df = pd.DataFrame()
-
-# Get the unique student IDs
-#unique_student_ids = df.columns.str.extract(r'(\d+\.\d+)').dropna().squeeze().unique()
-unique_student_ids = df.columns.str.extract(r'([^_]+)$').dropna()[0].unique()
-
-
-# Iterate through each student and combine the data
-for student_id in unique_student_ids:
-    if(student_id == 'Date'):
-        continue
-    columns_with_id = df.columns[df.columns.str.contains(student_id)]
-    student_data = {
-        'ID': student_id,
-        'steps': df[columns_with_id[::25]].values.flatten(),
-        'heart': df[columns_with_id[1::25]].values.flatten(),
-        'distance': df[columns_with_id[2::25]].values.flatten(),
-        'sleep': df[columns_with_id[3::25]].values.flatten(),
-        'calories': df[columns_with_id[4::25]].values.flatten(),
-        'ThermalSens' : df[columns_with_id[7::25]].values.flatten(),
-        'TempSatisf': df[columns_with_id[8::25]].values.flatten(),
-        'ThermEnh/Int': df[columns_with_id[9::25]].values.flatten(),
-        'AirSatisf_1': df[columns_with_id[10::25]].values.flatten(),
-        'OutdoorAirAmount_1': df[columns_with_id[11::25]].values.flatten(),
-        'AirEnh/Int_1' : df[columns_with_id[12::25]].values.flatten(),
-        'LightSatisf_1': df[columns_with_id[13::25]].values.flatten(),
-        'LightSatisf_2': df[columns_with_id[14::25]].values.flatten(),
-        'LightAmount_1': df[columns_with_id[15::25]].values.flatten(),
-        'LightEnh/Int_1': df[columns_with_id[16::25]].values.flatten(),
-        'NoiseSatisf_1': df[columns_with_id[17::25]].values.flatten(),
-        'NoiseEnh/Int_1': df[columns_with_id[18::25]].values.flatten(),
-        'EnvSatisf_1': df[columns_with_id[19::25]].values.flatten(),
-        'LearnIncr/Decr_1': df[columns_with_id[20::25]].values.flatten(),
-        'CPUSpeed_1': df[columns_with_id[21::25]].values.flatten(),
-        'InternetSpeed_1': df[columns_with_id[22::25]].values.flatten(),
-        'DownloadSpeed': df[columns_with_id[23::25]].values.flatten(),
-        'UploadSpeed': df[columns_with_id[24::25]].values.flatten(),
-        'CESD': df[columns_with_id[5::25]].values.flatten(),
-        'STAI': df[columns_with_id[6::25]].values.flatten(),
-    }
-
-    # Creating a temporary data frame for each student and appending to the main data frame
-    student_df = pd.DataFrame(student_data)
-    new_df = pd.concat([new_df, student_df], ignore_index=True)
-
-    new_df = new_df.dropna(subset=['steps'])
-
-new_df.to_csv("/Users/oliviaraisbeck/Downloads/MQP/filled_6.csv") #change to your file location
\ No newline at end of file
+import frames
+import instrument
+import intraday
+
+file_path = "/Users/oliviaraisbeck/Downloads/MQP"  # change to your file location
+
+# Survey answers are spread back over the days before each survey
+SURVEY_PREFIXES = ('CESD', 'STAI', 'ThermalSens', 'TempSatisf', 'ThermEnh/Int', 'AirSatisf_1', 'OutdoorAirAmount_1',
+                   'AirEnh/Int_1', 'LightSatisf_1', 'LightSatisf_2', 'LightAmount_1', 'LightEnh/Int_1', 'NoiseSatisf_1',
+                   'NoiseEnh/Int_1', 'EnvSatisf_1', 'LearnIncr/Decr_1', 'CPUSpeed_1', 'InternetSpeed_1', 'DownloadSpeed',
+                   'UploadSpeed')
+# Fitbit aggregates are filled in between the first and last day a student has data
+SENSOR_PREFIXES = ('step', 'heart', 'distance', 'sleep', 'calories')
+# Columns of filled_6.csv, keyed by the prefix of the matching all.csv columns
+RESHAPE_FEATURES = {'step': 'steps', 'heart': 'heart', 'distance': 'distance', 'sleep': 'sleep',
+                    'calories': 'calories', 'ThermalSens': 'ThermalSens', 'TempSatisf': 'TempSatisf',
+                    'ThermEnh/Int': 'ThermEnh/Int', 'AirSatisf_1': 'AirSatisf_1',
+                    'OutdoorAirAmount_1': 'OutdoorAirAmount_1', 'AirEnh/Int_1': 'AirEnh/Int_1',
+                    'LightSatisf_1': 'LightSatisf_1', 'LightSatisf_2': 'LightSatisf_2',
+                    'LightAmount_1': 'LightAmount_1', 'LightEnh/Int_1': 'LightEnh/Int_1',
+                    'NoiseSatisf_1': 'NoiseSatisf_1', 'NoiseEnh/Int_1': 'NoiseEnh/Int_1',
+                    'EnvSatisf_1': 'EnvSatisf_1', 'LearnIncr/Decr_1': 'LearnIncr/Decr_1', 'CPUSpeed_1': 'CPUSpeed_1',
+                    'InternetSpeed_1': 'InternetSpeed_1', 'DownloadSpeed': 'DownloadSpeed',
+                    'UploadSpeed': 'UploadSpeed', 'CESD': 'CESD', 'STAI': 'STAI'}
+
+
+def fill_surveys(df, prefixes=SURVEY_PREFIXES):
+    """
+    Back-fills every survey column so each day gets the answers of the next survey
+
+    :param df: data frame of all.csv, changed in place
+    :param prefixes: prefixes of the survey columns
+    :return: df
+    """
+    survey_columns = [col for col in df.columns if col.startswith(tuple(prefixes))]
+    df[survey_columns] = df[survey_columns].bfill()
+    return df
+
+
+def mask_low_steps(df, threshold=250, span=4, step_prefix='step_'):
+    """
+    Takes out the days a student barely wore the Fitbit: wherever a step column is below the threshold,
+    the step column and the span columns after it (the rest of that student's features) are set to NaN,
+    together with the student's extra statistic columns (see intraday)
+
+    :param df: data frame of all.csv, changed in place
+    :param threshold: days with fewer steps than this are taken out
+    :param span: number of columns after each step column to take out as well
+    :param step_prefix: prefix of the step columns
+    :return: df
+    """
+    step_positions, extras = [], {}
+    for i, col in enumerate(df.columns):
+        extra = intraday.split_extra(col)
+        if extra is not None:
+            # Keyed like the step column they belong to, by the ID and the cohort suffix of main.combine if any
+            extras.setdefault(extra[2], []).append(i)
+        elif col.startswith(step_prefix):
+            step_positions.append(i)
+    step_positions = np.array(step_positions, dtype=int)
+    if len(step_positions) == 0:
+        return df
+    # One boolean mask over the whole table, built from all the step columns at once
+    low_steps = df.iloc[:, step_positions].lt(threshold).to_numpy()
+    mask = np.zeros(df.shape, dtype=bool)
+    for offset in range(span + 1):
+        targets = step_positions + offset
+        inside = targets < df.shape[1]
+        mask[:, targets[inside]] |= low_steps[:, inside]
+    for j, position in enumerate(step_positions):
+        for target in extras.get(df.columns[position][len(step_prefix):], []):
+            mask[:, target] |= low_steps[:, j]
+    for position in np.flatnonzero(mask.any(axis=0)):
+        df.isetitem(position, df.iloc[:, position].mask(mask[:, position]))
+    return df
+
+
+def fill_sensors(df, prefixes=SENSOR_PREFIXES, strategy='mean'):
+    """
+    Fills the missing Fitbit values between the first and last day each column has data
+
+    :param df: data frame of all.csv, changed in place
+    :param prefixes: prefixes of the Fitbit columns
+    :param strategy: statistic of the column used as the fill value, 'mean' or 'median'
+    :return: df
+    """
+    positions = np.array([i for i, col in enumerate(df.columns) if col.startswith(tuple(prefixes))], dtype=int)
+    if len(positions) == 0 or len(df) == 0:
+        return df
+    columns = df.iloc[:, positions]
+    fill_values = columns.agg(strategy).to_numpy(dtype='float64')
+    present = columns.notna().to_numpy()
+
+    # First and last row with data in every column
+    first = present.argmax(axis=0)
+    last = len(df) - 1 - present[::-1].argmax(axis=0)
+    # Like the original script, columns whose data starts on the first row are not filled
+    fillable = present.any(axis=0) & (first > 0)
+    rows = np.arange(len(df))[:, np.newaxis]
+    to_fill = ~present & (rows >= first) & (rows <= last) & fillable
+
+    for j in np.flatnonzero(to_fill.any(axis=0)):
+        df.isetitem(positions[j], df.iloc[:, positions[j]].mask(to_fill[:, j], fill_values[j]))
+    return df
+
+
+def reshape(df, features=RESHAPE_FEATURES):
+    """
+    Reformats the wide table into one row per student and day, with one column per feature.
+    Every column name is parsed once into its feature and student ID (the text after the last '_'),
+    so a student missing a column only gets NaN for that feature. Days without steps are dropped.
+
+    :param df: data frame of filled.csv
+    :param features: dict of column prefix -> output column name, in output order
+    :return: data frame with an 'ID' column followed by the feature columns
+    """
+    students = {}
+    positions, student_index, feature_index = [], [], []
+    feature_order = {feature: j for j, feature in enumerate(features)}
+    for position, col in enumerate(df.columns):
+        if '_' not in col:
+            continue
+        feature, student_id = col.rsplit('_', 1)
+        if feature in feature_order:
+            positions.append(position)
+            student_index.append(students.setdefault(student_id, len(students)))
+            feature_index.append(feature_order[feature])
+
+    # Scatter every column into a (student, day, feature) array, then stack the students on top of each other
+    values = df.iloc[:, positions].to_numpy(dtype='float64', na_value=np.nan)
+    stacked = np.full((len(students), len(df), len(features)), np.nan)
+    stacked[student_index, :, feature_index] = values.T
+    new_df = pd.DataFrame(stacked.reshape(len(students) * len(df), len(features)), columns=list(features.values()))
+    new_df.insert(0, 'ID', np.repeat(list(students), len(df)))
+
+    return new_df.dropna(subset=['steps']).reset_index(drop=True)
+
+
+def impute(df, threshold=250, span=4, strategy='mean'):
+    """
+    Runs the survey back-fill, the low step masking and the Fitbit fill on all.csv
+
+    :param df: data frame of all.csv, changed in place
+    :param threshold: days with fewer steps than this are taken out
+    :param span: number of columns after each step column to take out as well
+    :param strategy: statistic of the column used as the fill value, 'mean' or 'median'
+    :return: df
+    """
+    fill_surveys(df)
+    mask_low_steps(df, threshold, span)
+    fill_sensors(df, strategy=strategy)
+    return df
+
+
+if __name__ == "__main__":
+    with instrument.stage("impute"):
+        df = frames.read_frame(file_path + "/all.csv")
+        impute(df)
+        df.to_csv(file_path + "/filled.csv")
+
+    with instrument.stage("reshape"):
+        new_df = reshape(df)
+        new_df.to_csv(file_path + "/filled_6.csv")
@@ -0,0 +1,278 @@
+# Records wall time, CPU time, files, bytes, rows, failures and memory of every pipeline stage as JSON lines
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak memory is then left out
+    resource = None
+
+# Where finished stages are written, set by start_run
+_run = {"path": None, "id": None}
+_lock = threading.Lock()
+# Stages open on each thread, every count goes to all of them so outer stages include inner ones
+_local = threading.local()
+# Counts made while no stage is open, like in pool workers, until collect hands them back
+_pending = {"files": 0, "bytes": 0, "rows": 0, "failures": 0, "failed_files": []}
+
+# Failed files kept per stage, the failure count itself is not capped
+MAX_FAILED_FILES = 100
+
+# Seconds between two memory samples while a stage is open, spikes shorter than this can be missed
+SAMPLE_INTERVAL = 0.02
+# Records of the stages open on any thread, the sampler raises their peak_rss_mb
+_open = []
+_memory_lock = threading.Lock()
+_sampler = {"thread": None}
+
+
+def start_run(path, run_id=None):
+    """
+    Starts writing a JSON line for every finished stage to a file
+
+    :param path: path of the jsonl file, appended to
+    :param run_id: id stored with every line, a timestamp by default
+    :return: the run id
+    """
+    _run["path"] = path
+    _run["id"] = run_id if run_id is not None else time.strftime("%Y%m%dT%H%M%S")
+    return _run["id"]
+
+
+def run_settings():
+    """
+    Settings of the current run, to start the same run in a worker process
+
+    :return: tuple of (path, run id), as arguments for start_run
+    """
+    return _run["path"], _run["id"]
+
+
+def _stages():
+    """
+    :return: list of the stages open on this thread, innermost last
+    """
+    if not hasattr(_local, "stages"):
+        _local.stages = []
+    return _local.stages
+
+
+def count(files=0, bytes_read=0, rows=0):
+    """
+    Adds to the counters of the open stages
+
+    :param files: number of files read
+    :param bytes_read: number of bytes read
+    :param rows: number of rows parsed
+    :return: void
+    """
+    targets = _stages() or [_pending]
+    for target in targets:
+        target["files"] += files
+        target["bytes"] += bytes_read
+        target["rows"] += rows
+
+
+def failure(file_path, error):
+    """
+    Counts a file that could not be processed
+
+    :param file_path: path of the file
+    :param error: the exception, or its description
+    :return: void
+    """
+    if not isinstance(error, str):
+        error = repr(error)
+    targets = _stages() or [_pending]
+    for target in targets:
+        target["failures"] += 1
+        if len(target["failed_files"]) < MAX_FAILED_FILES:
+            target["failed_files"].append({"path": file_path, "error": error})
+
+
+def collect():
+    """
+    Hands over the counts made outside any stage and resets them, for pool workers to return to the parent
+
+    :return: dict of counts to pass to merge
+    """
+    counts = dict(_pending, failed_files=list(_pending["failed_files"]))
+    _pending.update(files=0, bytes=0, rows=0, failures=0, failed_files=[])
+    return counts
+
+
+def merge(counts):
+    """
+    Adds counts returned by collect in another process to the open stages
+
+    :param counts: dict from collect
+    :return: void
+    """
+    count(counts["files"], counts["bytes"], counts["rows"])
+    for failed in counts["failed_files"]:
+        failure(failed["path"], failed["error"])
+    # Failures beyond the ones listed still count
+    extra = counts["failures"] - len(counts["failed_files"])
+    for target in _stages() or [_pending]:
+        target["failures"] += extra
+
+
+def rss_mb():
+    """
+    :return: current resident memory of this process in MB, None where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def process_peak_rss_mb():
+    """
+    :return: peak resident memory of this process since it started in MB, None where it cannot be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _raise_peaks(rss):
+    """
+    Raises the peak of every open stage to the given memory
+
+    :param rss: resident memory in MB
+    :return: void
+    """
+    with _memory_lock:
+        for record in _open:
+            if rss > record["peak_rss_mb"]:
+                record["peak_rss_mb"] = rss
+
+
+def _sample():
+    """
+    Samples the resident memory until no stage is open anymore, run on its own thread
+
+    :return: void
+    """
+    while True:
+        with _memory_lock:
+            if not _open:
+                _sampler["thread"] = None
+                return
+        _raise_peaks(rss_mb())
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def _open_stage(record):
+    """
+    Starts following the memory of a stage, and the sampler thread if it is not running
+
+    :param record: dict of the stage
+    :return: void
+    """
+    rss = rss_mb()
+    record["rss_start_mb"] = rss
+    if rss is None:
+        return
+    record["peak_rss_mb"] = rss
+    with _memory_lock:
+        _open.append(record)
+        if _sampler["thread"] is None:
+            _sampler["thread"] = threading.Thread(target=_sample, name="instrument-memory", daemon=True)
+            _sampler["thread"].start()
+
+
+def _close_stage(record):
+    """
+    Stops following the memory of a stage and stores its memory at the end
+
+    :param record: dict of the stage
+    :return: void
+    """
+    rss = rss_mb()
+    record["rss_end_mb"] = rss
+    if record["rss_start_mb"] is None:
+        record["peak_rss_mb"] = None
+        return
+    _raise_peaks(rss)
+    with _memory_lock:
+        _open.remove(record)
+
+
+@contextmanager
+def stage(name, **tags):
+    """
+    Measures one stage of the pipeline. The record is written when the stage ends, also if it fails.
+
+    :param name: name of the stage
+    :param tags: extra fields stored with the record, like the cohort or feature
+    :return: context manager giving the record of the stage
+    """
+    record = dict(tags, stage=name, files=0, bytes=0, rows=0, failures=0, failed_files=[])
+    stages = _stages()
+    stages.append(record)
+    _open_stage(record)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        stages.pop()
+        record["wall_s"] = time.perf_counter() - wall
+        # Process-wide, so it includes other threads but not pool workers
+        record["cpu_s"] = time.process_time() - cpu
+        # peak_rss_mb is the highest sampled memory during this stage, process_peak_rss_mb the
+        # high-water mark of the whole process so far, which can come from an earlier stage
+        _close_stage(record)
+        record["process_peak_rss_mb"] = process_peak_rss_mb()
+        record["pid"] = os.getpid()
+        _write(record)
+
+
+def _write(record):
+    """
+    Appends a finished stage to the run file
+
+    :param record: dict of the stage
+    :return: void
+    """
+    if _run["path"] is None:
+        return
+    line = json.dumps(dict(record, run=_run["id"]), default=str)
+    with _lock:
+        with open(_run["path"], "a") as f:
+            f.write(line + "\n")
+
+
+def _after_fork():
+    """
+    Starts a forked child, like a pool worker, without the stages that were open in the parent.
+    The child inherits the parent's stages as copies nobody reads, so its counts would never reach collect.
+
+    :return: void
+    """
+    global _lock, _local, _memory_lock
+    _lock = threading.Lock()
+    _local = threading.local()
+    _pending.update(files=0, bytes=0, rows=0, failures=0, failed_files=[])
+    # The sampler thread does not exist in the child, and its lock may have been held at the fork
+    _memory_lock = threading.Lock()
+    _open.clear()
+    _sampler["thread"] = None
+
+
+if hasattr(os, "register_at_fork"):  # not available on Windows, which spawns its workers instead
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,199 @@
+# Extra daily statistics of the intraday Fitbit files, computed from the data column that was already read
+
+import numpy as np
+
+# Names of the Fitbit features, whose extra statistics are stored as <feature>_<statistic>_<ID> columns
+FITBIT_FEATURES = ("ID", "step", "heart", "distance", "sleep", "calories")
+
+# A suggested spec of the extra statistics of each feature, for Process.run_all(statistics=...)
+EXTRA_STATISTICS = {
+    "step": ("max", "std", "active_minutes", "hourly"),
+    "heart": ("min", "max", "std"),
+    "distance": ("max", "active_minutes"),
+    "sleep": ("episodes",),
+    "calories": ("max", "std"),
+}
+
+
+def _min(values, present):
+    return float(values[present].min()) if present.any() else np.nan
+
+
+def _max(values, present):
+    return float(values[present].max()) if present.any() else np.nan
+
+
+def _std(values, present):
+    # Sample standard deviation, like pandas
+    return float(values[present].std(ddof=1)) if present.sum() > 1 else np.nan
+
+
+def _count(values, present):
+    return int(present.sum())
+
+
+def _active_minutes(values, present):
+    return int((values[present] > 0).sum())
+
+
+def _episodes(values, present):
+    # Runs of consecutive rows equal to 1 (asleep)
+    asleep = values == 1
+    return int(asleep[0] + (asleep[1:] & ~asleep[:-1]).sum()) if len(values) else 0
+
+
+def _hourly(values, present):
+    # Rows are taken as evenly spread over the day, as in the minute-level exports
+    hours = np.arange(len(values)) * 24 // max(1, len(values))
+    sums = np.bincount(hours[present], weights=values[present], minlength=24)
+    return {f"hour{hour:02d}": float(total) for hour, total in enumerate(sums)}
+
+
+# Statistic name -> function of the values and the mask of non-missing values,
+# giving one value or a dict of column name -> value. fold and fold_result compute the same over chunks.
+STATISTICS = {
+    "min": _min,
+    "max": _max,
+    "std": _std,
+    "count": _count,
+    "active_minutes": _active_minutes,
+    "episodes": _episodes,
+    "hourly": _hourly,
+}
+
+
+def compute(values, statistics):
+    """
+    Computes several statistics of one file's data column
+
+    :param values: 1-D float array of the data column
+    :param statistics: names of statistics in STATISTICS
+    :return: dict of column name -> value, in the order of statistics
+    """
+    present = ~np.isnan(values)
+    result = {}
+    for name in statistics:
+        value = STATISTICS[name](values, present)
+        if isinstance(value, dict):
+            result.update(value)
+        else:
+            result[name] = value
+    return result
+
+
+def start_fold(statistics, rows=None):
+    """
+    Starts computing statistics over a data column that is read in chunks, see fold
+
+    :param statistics: names of statistics in STATISTICS
+    :param rows: number of values in the whole column, needed by "hourly" to place the rows in the day
+    :return: state to pass to fold and fold_result
+    """
+    if "hourly" in statistics and rows is None:
+        raise ValueError("hourly needs the number of rows of the column")
+    return {"statistics": statistics, "rows": rows, "offset": 0, "min": np.inf, "max": -np.inf,
+            "count": 0, "mean": 0.0, "m2": 0.0, "active": 0, "episodes": 0, "asleep": False,
+            "hourly": np.zeros(24)}
+
+
+def fold(state, values):
+    """
+    Adds the next chunk of a data column to the statistics, holding nothing of the chunk afterwards
+
+    :param state: state from start_fold
+    :param values: 1-D float array of the next rows of the data column
+    :return: the state
+    """
+    present = ~np.isnan(values)
+    kept = values[present]
+    n = len(kept)
+    if n:
+        state["min"] = min(state["min"], float(kept.min()))
+        state["max"] = max(state["max"], float(kept.max()))
+        # Chan's pairwise update of the running mean and sum of squared deviations
+        mean = float(kept.mean())
+        m2 = float(((kept - mean) ** 2).sum())
+        total = state["count"] + n
+        delta = mean - state["mean"]
+        state["m2"] += m2 + delta * delta * state["count"] * n / total
+        state["mean"] += delta * n / total
+        state["count"] = total
+        state["active"] += int((kept > 0).sum())
+    if len(values):
+        # An episode going on at the end of the previous chunk is not counted again
+        asleep = values == 1
+        state["episodes"] += int((asleep[0] and not state["asleep"]) + (asleep[1:] & ~asleep[:-1]).sum())
+        state["asleep"] = bool(asleep[-1])
+    if "hourly" in state["statistics"]:
+        positions = np.arange(state["offset"], state["offset"] + len(values))
+        hours = np.minimum(positions * 24 // max(1, state["rows"]), 23)
+        state["hourly"] += np.bincount(hours[present], weights=kept, minlength=24)
+    state["offset"] += len(values)
+    return state
+
+
+def fold_result(state):
+    """
+    :param state: state from start_fold, after every chunk went through fold
+    :return: dict of column name -> value like compute gives for the whole column (up to float rounding)
+    """
+    result = {}
+    for name in state["statistics"]:
+        if name == "min":
+            result[name] = state["min"] if state["count"] else np.nan
+        elif name == "max":
+            result[name] = state["max"] if state["count"] else np.nan
+        elif name == "std":
+            result[name] = float(np.sqrt(state["m2"] / (state["count"] - 1))) if state["count"] > 1 else np.nan
+        elif name == "count":
+            result[name] = state["count"]
+        elif name == "active_minutes":
+            result[name] = state["active"]
+        elif name == "episodes":
+            result[name] = state["episodes"]
+        elif name == "hourly":
+            result.update({f"hour{hour:02d}": float(total) for hour, total in enumerate(state["hourly"])})
+    return result
+
+
+def column_names(statistics):
+    """
+    :param statistics: names of statistics in STATISTICS
+    :return: list of the column names compute gives for them
+    """
+    names = []
+    for name in statistics:
+        names.extend([f"hour{hour:02d}" for hour in range(24)] if name == "hourly" else [name])
+    return names
+
+
+def split_extra(col):
+    """
+    Splits an extra statistic column into its parts, recognising the statistic by its name
+
+    :param col: column name, with or without the ID suffix
+    :return: tuple of (feature, statistic column, rest after it) for <feature>_<statistic>[_<rest>] of a Fitbit
+             feature, None for the daily value, survey and other columns. The rest is the ID, followed by the
+             cohort for the columns main.combine suffixes
+    """
+    feature, _, rest = col.partition('_')
+    if feature not in FITBIT_FEATURES:
+        return None
+    for name in _EXTRA_NAMES:
+        if rest == name or rest.startswith(name + '_'):
+            return feature, name, rest[len(name) + 1:]
+    return None
+
+
+def is_extra(prefix):
+    """
+    Tells the extra statistic columns apart from the daily value and survey columns
+
+    :param prefix: column name without the ID suffix
+    :return: True for <feature>_<statistic> of a Fitbit feature and a statistic of column_names
+    """
+    return split_extra(prefix) is not None
+
+
+# Every column name compute can give, longest first so no name is cut short by another it starts with
+_EXTRA_NAMES = sorted(column_names(STATISTICS), key=len, reverse=True)
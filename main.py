@@ -1,50 +1,243 @@
 # starting over
 import Preprocess
+import cache
+import dataset
+import frames
+import instrument
+import reader
 import survey
 from Preprocess import run_preprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from Process import run_all
+import numpy as np
 import pandas as pd
 
 file_path = "/Users/oliviaraisbeck/Downloads/MQP"
 
 
-def combine(file_path):
-    final_data = pd.DataFrame()
+def combine(file_path, files=None, compact=False, dataset_path=None, streaming=False):
+    """
+           Merges the cohort files on their Date column into all.csv
 
-    for file in os.listdir(file_path):
-        if file.lower().endswith('.csv'):
-            file_data = pd.read_csv(os.path.join(file_path, file))
+           :param file_path: the data folder, every csv or parquet file in it is merged unless files is given
+           :param files: optional list of file names in the data folder to merge instead
+           :param compact: load the cohort files in compact types (see frames.compact)
+           :param dataset_path: optional folder to also write every cohort to, one file per student (see dataset)
+           :param streaming: merge the files a chunk at a time (see combine_streaming), unless compact or
+                             dataset_path need whole cohorts in memory
+           :return: void
+   """
+    with instrument.stage("combine"):
+        if streaming and not compact and not dataset_path:
+            if combine_streaming(file_path, files):
+                return
+            print("Cohort files are not sorted by unique dates, merging them in memory")
+        final_data = pd.DataFrame()
 
-            if final_data.empty:
-                final_data = file_data
-            else:
-                final_data = pd.merge(final_data, file_data, on='Date', how='outer',
-                                      suffixes=('', f'_{os.path.splitext(file)[0]}'))
+        for file in (files if files is not None else os.listdir(file_path)):
+            if file.lower().endswith(('.csv', '.parquet')):
+                file_data = frames.read_frame(os.path.join(file_path, file), compact)
+                if dataset_path:
+                    dataset.write_cohort(dataset_path, os.path.splitext(file)[0], file_data)
 
-    # Convert 'Date' to datetime for proper sorting
-    if 'Date' in final_data.columns:
-        # Sort the DataFrame by the 'Date' column
-        final_data.sort_values(by='Date', inplace=True)
+                if final_data.empty:
+                    final_data = file_data
+                else:
+                    final_data = pd.merge(final_data, file_data, on='Date', how='outer',
+                                          suffixes=('', f'_{os.path.splitext(file)[0]}'))
 
-        # Reset the index
-        final_data.reset_index(drop=True, inplace=True)
+        # Convert 'Date' to datetime for proper sorting
+        if 'Date' in final_data.columns:
+            # Sort the DataFrame by the 'Date' column
+            final_data.sort_values(by='Date', inplace=True)
 
-        # Save the updated DataFrame to a new CSV file
-        final_data.to_csv(os.path.join(file_path, "all.csv"), index=False)
+            # Reset the index
+            final_data.reset_index(drop=True, inplace=True)
 
+            # Save the updated DataFrame to a new CSV file
+            final_data.to_csv(os.path.join(file_path, "all.csv"), index=False)
 
-def process(file_path):
+
+def combine_streaming(file_path, files=None, memory_limit=None):
+    """
+           Merges the cohort files into all.csv like combine, holding one chunk per file instead of every file.
+           A first pass reads the dates and column types of every file, the second merges the chunks in date
+           order and appends the rows to all.csv, so the output is the same as that of combine.
+
+           :param file_path: the data folder, every csv or parquet file in it is merged unless files is given
+           :param files: optional list of file names in the data folder to merge instead
+           :param memory_limit: bytes a csv chunk may take, defaults to reader.MEMORY_LIMIT
+           :return: False without writing anything if a file is not sorted by unique dates, True otherwise
+   """
+    names = [file for file in (files if files is not None else os.listdir(file_path))
+             if file.lower().endswith(('.csv', '.parquet'))]
+    paths = [os.path.join(file_path, file) for file in names]
+
+    # First pass: the dates and the type every column has when the whole file is read
+    file_dates, file_types = [], []
+    for path in paths:
+        dates, types = [], {}
+        for chunk in frames.iter_frame(path, memory_limit=memory_limit):
+            dates.append(chunk['Date'].to_numpy())
+            for col in chunk.columns:
+                dtype = chunk[col].dtype
+                if col not in types:
+                    types[col] = dtype
+                elif types[col] != dtype:
+                    objects = object in (types[col], dtype)
+                    types[col] = np.dtype(object) if objects else np.result_type(types[col], dtype)
+        dates = pd.Index(np.concatenate(dates) if dates else [])
+        if not (dates.is_monotonic_increasing and dates.is_unique):
+            return False
+        file_dates.append(dates)
+        file_types.append(types)
+    if not paths:
+        return True
+
+    # Column names and types of the merged table, renamed like the suffixes of pd.merge
+    all_dates = file_dates[0]
+    for dates in file_dates[1:]:
+        all_dates = all_dates.union(dates)
+    output_types = {'Date': file_types[0]['Date']}
+    renames = []
+    for name, dates, types in zip(names, file_dates, file_types):
+        rename = {}
+        for col, dtype in types.items():
+            if col == 'Date':
+                continue
+            rename[col] = col + "_" + os.path.splitext(name)[0] if col in output_types else col
+            # Days missing from the file become NaN, which integer and bool columns cannot hold
+            if len(dates) < len(all_dates) and dtype.kind in 'iub':
+                dtype = np.dtype('float64') if dtype.kind in 'iu' else np.dtype(object)
+            output_types[rename[col]] = dtype
+        renames.append(rename)
+
+    # Second pass: every round writes the days up to the smallest last date among the chunks being held
+    # (those days are complete, the files are sorted) and reads the next chunk of the files it used up
+    read_types = [{col: str for col, dtype in types.items() if dtype == object} for types in file_types]
+    chunks = [frames.iter_frame(path, dtype, memory_limit) for path, dtype in zip(paths, read_types)]
+    held = [next((chunk for chunk in file_chunks if len(chunk)), None) for file_chunks in chunks]
+    temp_path = os.path.join(file_path, "all.csv.tmp")
+    with open(temp_path, "w", newline="") as f:
+        header = True
+        while any(chunk is not None for chunk in held):
+            bound = min(chunk['Date'].iloc[-1] for chunk in held if chunk is not None)
+            parts = []
+            for i, chunk in enumerate(held):
+                if chunk is None:
+                    continue
+                done = chunk['Date'] <= bound
+                parts.append(chunk[done].set_index('Date').rename(columns=renames[i]))
+                if done.all():
+                    held[i] = next((chunk for chunk in chunks[i] if len(chunk)), None)
+                else:
+                    held[i] = chunk[~done]
+            merged = pd.concat(parts, axis=1).sort_index()
+            merged = merged.reindex(columns=list(output_types)[1:]).reset_index()
+            merged.astype(output_types).to_csv(f, header=header, index=False)
+            header = False
+    os.replace(temp_path, os.path.join(file_path, "all.csv"))
+    return True
+
+
+def init_worker(engine, memory_limit, metrics_path, run_id):
+    """
+           Gives a pool worker the reader settings and the metrics file of the parent
+
+           :return: void
+   """
+    reader.configure(engine, memory_limit)
+    if metrics_path:
+        instrument.start_run(metrics_path, run_id)
+
+
+def export_cohort(cohort_path, output_path, *args):
+    """
+           Runs Process.run_all on a cohort as one measured stage
+
+           :param cohort_path: path of the cohort
+           :param output_path: path to export the cohort to
+           :param args: the other arguments of run_all
+           :return: void
+   """
+    with instrument.stage("cohort", cohort=os.path.basename(cohort_path)):
+        run_all(cohort_path, output_path, *args)
+
+
+def process(file_path, in_memory=False, output_format="csv", workers=1, cache_path=None, content_hash=False,
+            virtual=False, memory_limit=None, metrics_path=None, cohorts=None, combined=True,
+            compact=False, dataset_path=None, statistics=None, store_root=None, survey_join='merge',
+            streaming=False):
+    """
+           Preprocesses and exports every cohort in the data folder, then combines them into all.csv
+
+           :param file_path: the data folder containing one folder per cohort
+           :param in_memory: build each cohort in memory and write it once (see Process.run_all)
+           :param output_format: "csv" or "parquet", the format of the per-cohort files
+           :param workers: number of processes to use, 1 runs everything in this process
+           :param cache_path: optional json file caching the daily value of every parsed file between runs
+           :param content_hash: also compare file contents, not only size and mtime, before using a cached value
+           :param virtual: leave the raw export untouched and read the files from a manifest (see Preprocess.build_manifest)
+           :param memory_limit: bytes an intraday file may take before it is read in chunks (see reader.MEMORY_LIMIT)
+           :param metrics_path: optional jsonl file to append the measurements of every stage to (see instrument)
+           :param cohorts: optional list of cohort folder names to export, all of them by default
+           :param combined: combine the cohort files into all.csv afterwards
+           :param compact: store the cohort files and all.csv in compact types (see frames.compact)
+           :param dataset_path: optional folder to also write the combined data to, one file per student (see dataset)
+           :param statistics: optional dict of feature -> names of extra statistics (see intraday.EXTRA_STATISTICS)
+           :param store_root: optional folder holding a store of the minute values per cohort (see store),
+                              built the first time and reduced instead of parsing the files after that,
+                              to be deleted when the raw files change
+           :param survey_join: 'merge' or 'asof', how the surveys are joined onto the days (see survey.add_surveys)
+           :param streaming: combine the cohort files a chunk at a time (see combine_streaming)
+           :return: void
+   """
+    reader.configure(memory_limit=memory_limit)
+    if metrics_path:
+        instrument.start_run(metrics_path)
+    cohort_paths = []
+    output_paths = []
     for cohort in os.listdir(file_path):
         if not (cohort == '.git'):  # registers .git as a directory if it is in there
+            if cohorts is not None and cohort not in cohorts:
+                continue
+            if os.path.exists(os.path.join(file_path, cohort, dataset.INDEX_FILE)):  # written by combine, not a cohort
+                continue
+            if store_root and os.path.abspath(os.path.join(file_path, cohort)) == os.path.abspath(store_root):
+                continue
             if os.path.isdir(os.path.join(file_path, cohort)):
-                cohort_path = file_path + "/" + cohort
-                run_preprocessing(cohort_path)
-                run_all(cohort_path, file_path + "/" + cohort + ".csv")
-    combine(file_path)
+                cohort_paths.append(file_path + "/" + cohort)
+                output_paths.append(file_path + "/" + cohort + "." + output_format)
+
+    store_paths = [os.path.join(store_root, os.path.basename(cohort_path)) if store_root else None
+                   for cohort_path in cohort_paths]
+    aggregate_cache = cache.load(cache_path, content_hash) if cache_path else None
+    if workers <= 1:
+        for cohort_path, output_path, store_path in zip(cohort_paths, output_paths, store_paths):
+            with instrument.stage("cohort", cohort=os.path.basename(cohort_path)):
+                manifest = run_preprocessing(cohort_path, virtual)
+                run_all(cohort_path, output_path, in_memory, None, aggregate_cache, manifest, compact, statistics,
+                        store_path, survey_join)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(reader.ENGINE, reader.MEMORY_LIMIT) + instrument.run_settings()) as executor:
+            # Cohorts are preprocessed one per worker, then every cohort is exported from its own thread
+            # with the students of all cohorts parsed on the shared process pool
+            manifests = list(executor.map(run_preprocessing, cohort_paths, repeat(virtual)))
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(cohort_paths)))) as threads:
+                list(threads.map(lambda args: export_cohort(args[0], args[1], in_memory, executor, aggregate_cache,
+                                                            args[2], compact, statistics, args[3], survey_join),
+                                 zip(cohort_paths, output_paths, manifests, store_paths)))
+    if aggregate_cache is not None:
+        cache.save(aggregate_cache, cache_path)
+    if combined:
+        combine(file_path, compact=compact, dataset_path=dataset_path, streaming=streaming)
 
 
-# data = pd.DataFrame()
-# survey.student(file_path + "/E1 term" , data)
+if __name__ == "__main__":
+    # data = pd.DataFrame()
+    # survey.student(file_path + "/E1 term" , data)
 
-process(file_path)
+    process(file_path)
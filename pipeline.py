@@ -0,0 +1,246 @@
+# Make-style runner: rebuilds the cohort files, all.csv, filled.csv and filled_6.csv only when what they were built from changed
+
+import argparse
+import hashlib
+import json
+import os
+
+import dataset
+import frames
+import imputation
+import instrument
+import intraday
+import main
+
+STAGES = ("cohorts", "combine", "impute", "reshape")
+
+# Name of the file recording what every artifact was built from, kept in the data folder
+STATE_FILE = ".pipeline_state.json"
+
+
+def fingerprint(path):
+    """
+    Describes the current version of a file, or of every file below a folder
+
+    :param path: path of the file or folder
+    :return: list of the size and mtime in nanoseconds for a file, a sha1 over the relative path, size
+             and mtime of every file for a folder, None if the path does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def load_state(root):
+    """
+    Loads the state file of a data folder, or starts an empty state if there is none yet
+
+    :param root: the data folder
+    :return: dict of artifact name -> {"inputs": {path: fingerprint}, "params": {...}}
+    """
+    state_path = os.path.join(root, STATE_FILE)
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(root, state):
+    """
+    Writes the state file of a data folder
+
+    :param root: the data folder
+    :param state: dict from load_state
+    :return: void
+    """
+    state_path = os.path.join(root, STATE_FILE)
+    temp_path = state_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp_path, state_path)
+
+
+def is_stale(state, root, artifact, inputs, params):
+    """
+    Checks if an artifact has to be rebuilt
+
+    :param state: dict from load_state
+    :param root: the data folder
+    :param artifact: file name of the artifact in the data folder
+    :param inputs: dict of input path -> current fingerprint
+    :param params: dict of the parameters the artifact depends on
+    :return: True if the artifact is missing or was built from other inputs or parameters
+    """
+    record = state.get(artifact)
+    if record is None or not os.path.exists(os.path.join(root, artifact)):
+        return True
+    return record["inputs"] != inputs or record["params"] != params
+
+
+def record(state, root, artifact, inputs, params):
+    """
+    Stores what an artifact was built from and saves the state, so an interrupted run keeps the finished stages
+
+    :param state: dict from load_state
+    :param root: the data folder
+    :param artifact: file name of the artifact in the data folder
+    :param inputs: dict of input path -> fingerprint
+    :param params: dict of the parameters the artifact depends on
+    :return: void
+    """
+    state[artifact] = {"inputs": inputs, "params": params}
+    save_state(root, state)
+
+
+def cohort_names(root):
+    """
+    :param root: the data folder
+    :return: list of the cohort folders in it, in the order main.process finds them
+    """
+    return [cohort for cohort in os.listdir(root) if cohort != '.git' and os.path.isdir(os.path.join(root, cohort))
+            and not os.path.exists(os.path.join(root, cohort, dataset.INDEX_FILE))]
+
+
+def run(root, stages=STAGES, threshold=250, span=4, strategy='mean', output_format="csv", workers=1,
+        virtual=False, cache_path=None, force=False, metrics_path=None, compact=False,
+        partitioned=False, statistics=None, survey_join='merge', streaming=False):
+    """
+    Runs the selected stages, skipping every artifact that is up to date
+
+    :param root: the data folder containing one folder per cohort
+    :param stages: names of the stages to run, from STAGES
+    :param threshold: step threshold of the imputation (see imputation.impute)
+    :param span: days masked around a low step day (see imputation.impute)
+    :param strategy: how sensor gaps are filled (see imputation.impute)
+    :param output_format: "csv" or "parquet", the format of the per-cohort files
+    :param workers: number of processes to export the cohorts with
+    :param virtual: leave the raw export untouched (see Preprocess.build_manifest)
+    :param cache_path: optional json file caching the daily value of every parsed file (see cache)
+    :param force: rebuild the selected stages even if they are up to date
+    :param metrics_path: optional jsonl file to append the measurements of every stage to (see instrument)
+    :param compact: load and store every table in compact types (see frames.compact)
+    :param partitioned: also write all.csv and filled.csv as datasets with one file per student, in the
+                        dataset and filled_dataset folders of the data folder (see dataset)
+    :param statistics: optional dict of feature -> names of extra statistics (see intraday.EXTRA_STATISTICS)
+    :param survey_join: 'merge' or 'asof', how the surveys are joined onto the days (see survey.add_surveys)
+    :param streaming: combine the cohort files a chunk at a time, the result is the same (see main.combine_streaming)
+    :return: list of the artifacts that were rebuilt
+    """
+    if metrics_path:
+        instrument.start_run(metrics_path)
+    state = load_state(root)
+    built = []
+    cohorts = cohort_names(root)
+    outputs = [cohort + "." + output_format for cohort in cohorts]
+    # Stored like the json state file gives it back, so the comparison with the last run works
+    types = {"compact": compact, "statistics": {feature: list(names) for feature, names in (statistics or {}).items()},
+             "survey_join": survey_join}
+    dataset_path = os.path.join(root, "dataset") if partitioned else None
+
+    if "cohorts" in stages:
+        # Fingerprinted after the export, preprocessing moves and deletes files in the cohort folder
+        stale = [cohort for cohort, output in zip(cohorts, outputs)
+                 if force or is_stale(state, root, output, {cohort: fingerprint(os.path.join(root, cohort))}, types)]
+        if stale:
+            print("Exporting " + ", ".join(stale))
+            # Process.run_all merges into an existing output file, so the old export has to go first
+            for cohort in stale:
+                output_path = os.path.join(root, cohort + "." + output_format)
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            main.process(root, output_format=output_format, workers=workers, cache_path=cache_path,
+                         virtual=virtual, cohorts=stale, combined=False, compact=compact,
+                         statistics=statistics, survey_join=survey_join)
+            for cohort in stale:
+                output = cohort + "." + output_format
+                record(state, root, output, {cohort: fingerprint(os.path.join(root, cohort))}, types)
+                built.append(output)
+
+    if "combine" in stages:
+        inputs = {output: fingerprint(os.path.join(root, output)) for output in outputs}
+        params = dict(types, partitioned=partitioned)
+        if force or is_stale(state, root, "all.csv", inputs, params):
+            print("Combining " + ", ".join(outputs))
+            # Merged in directory order like main.combine, which decides the column order of all.csv
+            main.combine(root, [file for file in os.listdir(root) if file in outputs], compact, dataset_path,
+                         streaming)
+            record(state, root, "all.csv", inputs, params)
+            built.append("all.csv")
+
+    df = None
+    if "impute" in stages:
+        inputs = {"all.csv": fingerprint(os.path.join(root, "all.csv"))}
+        params = dict(types, partitioned=partitioned, threshold=threshold, span=span, strategy=strategy)
+        if force or is_stale(state, root, "filled.csv", inputs, params):
+            print("Imputing all.csv")
+            with instrument.stage("impute"):
+                df = frames.read_frame(os.path.join(root, "all.csv"), compact)
+                imputation.impute(df, threshold, span, strategy)
+                df.to_csv(os.path.join(root, "filled.csv"))
+                if partitioned:
+                    # Students keep the cohorts they have in the combined dataset
+                    dataset.write(os.path.join(root, "filled_dataset"), df, dataset.cohorts(dataset_path))
+            record(state, root, "filled.csv", inputs, params)
+            built.append("filled.csv")
+
+    if "reshape" in stages:
+        inputs = {"filled.csv": fingerprint(os.path.join(root, "filled.csv"))}
+        if force or is_stale(state, root, "filled_6.csv", inputs, types):
+            print("Reshaping filled.csv")
+            with instrument.stage("reshape"):
+                if df is None:
+                    df = frames.read_frame(os.path.join(root, "filled.csv"), compact).set_index("Unnamed: 0")
+                new_df = imputation.reshape(df)
+                if compact:
+                    sensors = [imputation.RESHAPE_FEATURES[prefix] for prefix in imputation.SENSOR_PREFIXES]
+                    frames.compact(new_df, sensors)
+                new_df.to_csv(os.path.join(root, "filled_6.csv"))
+            record(state, root, "filled_6.csv", inputs, types)
+            built.append("filled_6.csv")
+
+    if not built:
+        print("Everything is up to date")
+    return built
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the pipeline outputs that are out of date")
+    parser.add_argument("--root", default=main.file_path, help="data folder containing one folder per cohort")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to run, from " +
+                        ", ".join(STAGES))
+    parser.add_argument("--threshold", type=int, default=250)
+    parser.add_argument("--span", type=int, default=4)
+    parser.add_argument("--strategy", default="mean")
+    parser.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--virtual", action="store_true")
+    parser.add_argument("--cache", help="json file caching the daily value of every parsed file")
+    parser.add_argument("--metrics", help="jsonl file to append the stage measurements to")
+    parser.add_argument("--compact", action="store_true", help="store the tables in compact types")
+    parser.add_argument("--dataset", action="store_true",
+                        help="also write all.csv and filled.csv with one file per student")
+    parser.add_argument("--statistics", action="store_true",
+                        help="add the extra statistics of intraday.EXTRA_STATISTICS to the cohort files")
+    parser.add_argument("--survey-join", default="merge", choices=["merge", "asof"],
+                        help="asof gives every day the next survey instead of adding a row per survey")
+    parser.add_argument("--streaming", action="store_true", help="combine the cohort files a chunk at a time")
+    parser.add_argument("--force", action="store_true", help="rebuild the selected stages even if up to date")
+    args = parser.parse_args()
+
+    selected = args.stages.split(",")
+    for name in selected:
+        if name not in STAGES:
+            parser.error(f"unknown stage {name}")
+    run(args.root, selected, args.threshold, args.span, args.strategy, args.format, args.workers, args.virtual,
+        args.cache, args.force, args.metrics, args.compact, args.dataset,
+        intraday.EXTRA_STATISTICS if args.statistics else None, args.survey_join, args.streaming)
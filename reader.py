@@ -0,0 +1,158 @@
+# Reads only the data columns of the intraday Fitbit csv files
+
+import csv
+import os
+
+import pandas as pd
+
+import instrument
+
+try:
+    import pyarrow
+    import pyarrow.csv as pyarrow_csv
+except ImportError:  # pyarrow is optional, pandas' own parser is used without it
+    pyarrow = None
+    pyarrow_csv = None
+
+# Fixed dtype of the data columns of each feature, other features (like ID) keep type inference
+DTYPES = {
+    "step": "float64",
+    "heart": "float64",
+    "distance": "float64",
+    "sleep": "float64",
+    "calories": "float64",
+}
+
+# Parser used when none is given, pyarrow's when it is installed
+ENGINE = "pyarrow" if pyarrow_csv is not None else "c"
+
+# Files bigger than this many bytes are read in chunks that each fit in it
+MEMORY_LIMIT = 64 * 1024 * 1024
+
+
+def configure(engine=None, memory_limit=None):
+    """
+    Sets the parser and memory ceiling of this process, also usable as a process pool initializer
+
+    :param engine: "pyarrow" or "c", None keeps the current one
+    :param memory_limit: bytes a file may take before it is streamed in chunks, None keeps the current one
+    :return: void
+    """
+    global ENGINE, MEMORY_LIMIT
+    if engine is not None:
+        ENGINE = engine
+    if memory_limit is not None:
+        MEMORY_LIMIT = memory_limit
+
+
+def _header(file_path):
+    """
+    Reads the column names of a csv file
+
+    :param file_path: path of the csv file
+    :return: list of column names
+    """
+    with open(file_path, newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def read_columns(file_path, l, r, dtype=None, engine=None):
+    """
+    Reads columns l to r of a csv file, skipping the parsing of every other column
+
+    :param file_path: path of the csv file
+    :param l left side of the column containing the data
+    :param r right side of column containing the data
+    :param dtype: dtype of the columns, None to infer it
+    :param engine: "pyarrow" or "c", defaults to ENGINE
+    :return: dataframe holding only the columns l to r
+    """
+    if engine is None:
+        engine = ENGINE
+    if engine == "pyarrow" and pyarrow_csv is not None:
+        names = _header(file_path)[l:r]
+        column_types = {name: pyarrow.type_for_alias(dtype) for name in names} if dtype else None
+        table = pyarrow_csv.read_csv(
+            file_path,
+            read_options=pyarrow_csv.ReadOptions(use_threads=False),
+            convert_options=pyarrow_csv.ConvertOptions(include_columns=names, column_types=column_types),
+        )
+        df = table.to_pandas()
+    else:
+        df = pd.read_csv(file_path, usecols=range(l, r), dtype=dtype)
+    instrument.count(files=1, bytes_read=os.path.getsize(file_path), rows=len(df))
+    return df
+
+
+def chunk_rows(file_path, l, r, memory_limit):
+    """
+    Estimates how many rows of a file can be parsed at once within a memory ceiling,
+    from the average line length of its first 64 KB
+
+    :param file_path: path of the csv file
+    :param l left side of the column containing the data
+    :param r right side of column containing the data
+    :param memory_limit: bytes a chunk may take
+    :return: number of rows per chunk
+    """
+    with open(file_path, "rb") as f:
+        sample = f.read(65536)
+    line_bytes = len(sample) / max(1, sample.count(b"\n"))
+    # The parser holds the raw text of the chunk next to the parsed values
+    return max(1, int(memory_limit // (2 * line_bytes + 8 * (r - l))))
+
+
+def count_rows(file_path, block_size=1024 * 1024):
+    """
+    Counts the data rows of a csv file without parsing it, reading one block at a time
+
+    :param file_path: path of the csv file
+    :param block_size: bytes read at once
+    :return: number of non-blank lines after the header
+    """
+    rows = 0
+    rest = b""
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            lines = (rest + block).split(b"\n")
+            # The last line may continue in the next block
+            rest = lines.pop()
+            rows += sum(1 for line in lines if line.strip())
+    rows += bool(rest.strip())
+    return max(0, rows - 1)
+
+
+def iter_columns(file_path, l, r, dtype=None, engine=None, memory_limit=None):
+    """
+    Reads columns l to r of a csv file in chunks, so peak memory depends on the chunk size and not the file size
+
+    :param file_path: path of the csv file
+    :param l left side of the column containing the data
+    :param r right side of column containing the data
+    :param dtype: dtype of the columns, None to infer it
+    :param engine: "pyarrow" or "c", defaults to ENGINE
+    :param memory_limit: bytes a chunk may take, defaults to MEMORY_LIMIT
+    :return: generator of dataframes holding only the columns l to r
+    """
+    if engine is None:
+        engine = ENGINE
+    if memory_limit is None:
+        memory_limit = MEMORY_LIMIT
+    instrument.count(files=1, bytes_read=os.path.getsize(file_path))
+    if engine == "pyarrow" and pyarrow_csv is not None:
+        names = _header(file_path)[l:r]
+        column_types = {name: pyarrow.type_for_alias(dtype) for name in names} if dtype else None
+        stream = pyarrow_csv.open_csv(
+            file_path,
+            read_options=pyarrow_csv.ReadOptions(use_threads=False, block_size=max(4096, memory_limit // 2)),
+            convert_options=pyarrow_csv.ConvertOptions(include_columns=names, column_types=column_types),
+        )
+        for batch in stream:
+            instrument.count(rows=batch.num_rows)
+            yield batch.to_pandas()
+    else:
+        rows = chunk_rows(file_path, l, r, memory_limit)
+        with pd.read_csv(file_path, usecols=range(l, r), dtype=dtype, chunksize=rows) as chunks:
+            for chunk in chunks:
+                instrument.count(rows=len(chunk))
+                yield chunk
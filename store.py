@@ -0,0 +1,214 @@
+# Minute-level Fitbit values of a cohort packed into .npy arrays, so daily values can be recomputed without the csv files
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import instrument
+import intraday
+import reader
+
+# Name of the file listing the students, dates and features of a store, kept in the store folder
+INDEX_FILE = "index.json"
+
+# Longest file stored, two days of minute rows. A longer export, like one at second resolution, is parsed from
+# its csv file instead of padding the minute axis of every (student, day) slot to its length
+MAX_MINUTES = 2 * 1440
+
+
+def fingerprint(index, features):
+    """
+    Describes the files a store is built from, so a store of an older version of the cohort can be told apart
+
+    :param index: result of Process.index_cohort for the cohort
+    :param features: list of (feature, l, r) to store, like Process.FEATURES
+    :return: sha1 over the features and the path, size and mtime in nanoseconds of every file they are read from
+    """
+    digest = hashlib.sha1()
+    for feature, l, r in features:
+        digest.update(f"{feature}:{l}:{r}\n".encode())
+        for ID in sorted(index):
+            for date, file_paths in sorted(index[ID].get(feature, {}).items()):
+                # Kept in index order, the last file of a day is the one stored
+                for file_path in file_paths:
+                    try:
+                        stat = os.stat(file_path)
+                        version = f"{stat.st_size}:{stat.st_mtime_ns}"
+                    except OSError:
+                        version = "missing"
+                    digest.update(f"{ID}\0{date}\0{file_path}\0{version}\n".encode())
+    return digest.hexdigest()
+
+
+def _read_into(slot, file_path, feature, l, r):
+    """
+    Parses one intraday file straight into its slot of the store, in chunks when it is bigger than
+    reader.MEMORY_LIMIT, and pads the rest of the slot with NaN
+
+    :param slot: 1-D view of the (student, day) slot of the memory-mapped values
+    :param file_path: path of the csv file
+    :param feature: feature(step, calories, etc.) of the file
+    :param l left side of the column containing the data
+    :param r right side of column containing the data
+    :return: number of rows written, -1 if the file has more rows than the slot holds
+    """
+    dtype = reader.DTYPES.get(feature)
+    if os.path.getsize(file_path) > reader.MEMORY_LIMIT:
+        chunks = reader.iter_columns(file_path, l, r, dtype)
+    else:
+        chunks = [reader.read_columns(file_path, l, r, dtype)]
+    offset = 0
+    for chunk in chunks:
+        values = chunk.iloc[:, 0].to_numpy(dtype='float64')
+        if offset + len(values) > len(slot):
+            return -1
+        slot[offset:offset + len(values)] = values
+        offset += len(values)
+    slot[offset:] = np.nan
+    return offset
+
+
+def build(store_path, index, features, max_minutes=MAX_MINUTES):
+    """
+    Reads every intraday file of a cohort once and writes one (student, day, minute) array per feature,
+    NaN where there is no value, next to a (student, day) array of the rows of each file (-1 for no file).
+    Every file is written into the memory-mapped array as it is read, so only one file, or one chunk of an
+    oversized file, is held in memory. Days whose file is longer than max_minutes or cannot be read are
+    left out (-1), Process.store_student parses those from the csv files instead.
+
+    :param store_path: folder to write the store to
+    :param index: result of Process.index_cohort for the cohort
+    :param features: list of (feature, l, r) to store, like Process.FEATURES
+    :param max_minutes: longest file that is stored, the minute axis is as long as the longest file within it
+    :return: void
+    """
+    os.makedirs(store_path, exist_ok=True)
+    # Taken before reading, so a file changed during the build makes the store out of date
+    source = fingerprint(index, features)
+    students = list(index)
+    dates = sorted({date for files in index.values() for feature_files in files.values() for date in feature_files})
+    day = {date: d for d, date in enumerate(dates)}
+    stored = {}
+    for feature, l, r in features:
+        # The last file of a day wins, like the duplicate dates in frames.widen, so only that one is stored
+        files = {}
+        for s, ID in enumerate(students):
+            for date, file_paths in index[ID].get(feature, {}).items():
+                files[(s, day[date])] = file_paths[-1]
+        # First pass: count the rows without parsing, to size the minute axis
+        lengths = {}
+        for key, file_path in files.items():
+            try:
+                lengths[key] = reader.count_rows(file_path)
+            except OSError as e:
+                instrument.failure(file_path, e)
+        minutes = max([length for length in lengths.values() if length <= max_minutes], default=0)
+        # Created sparse, the slots are filled and padded one file at a time
+        values = np.lib.format.open_memmap(os.path.join(store_path, feature + ".npy"), mode="w+",
+                                           dtype="float64", shape=(len(students), len(dates), minutes))
+        rows = np.full((len(students), len(dates)), -1, dtype="int32")
+        for (s, d), length in lengths.items():
+            if length > minutes:
+                continue
+            try:
+                rows[s, d] = _read_into(values[s, d], files[(s, d)], feature, l, r)
+            except Exception as e:
+                instrument.failure(files[(s, d)], e)
+        values.flush()
+        del values
+        np.save(os.path.join(store_path, feature + "_rows.npy"), rows)
+        stored[feature] = minutes
+    with open(os.path.join(store_path, INDEX_FILE), "w") as f:
+        json.dump({"students": students, "dates": dates, "features": stored,
+                   "fingerprint": source}, f, indent=1)
+
+
+def exists(store_path):
+    """
+    :param store_path: folder of a store
+    :return: True if a store was written to it
+    """
+    return os.path.exists(os.path.join(store_path, INDEX_FILE))
+
+
+def is_current(store_path, index, features):
+    """
+    Tells whether a store was built from the cohort as it is now, with the same files, sizes and mtimes
+
+    :param store_path: folder of a store
+    :param index: result of Process.index_cohort for the cohort
+    :param features: list of (feature, l, r) the store should hold
+    :return: True if the store exists and its fingerprint matches, False if it has to be rebuilt
+    """
+    if not exists(store_path):
+        return False
+    with open(os.path.join(store_path, INDEX_FILE)) as f:
+        stored = json.load(f).get("fingerprint")
+    return stored == fingerprint(index, features)
+
+
+def open_store(store_path):
+    """
+    Opens a store with the values memory-mapped, so only the parts that are reduced are read
+
+    :param store_path: folder of the store
+    :return: store dict to pass to records
+    """
+    with open(os.path.join(store_path, INDEX_FILE)) as f:
+        store = json.load(f)
+    store["values"] = {}
+    store["rows"] = {}
+    for feature in store["features"]:
+        store["values"][feature] = np.load(os.path.join(store_path, feature + ".npy"), mmap_mode="r")
+        store["rows"][feature] = np.load(os.path.join(store_path, feature + "_rows.npy"))
+    store["students"] = {ID: s for s, ID in enumerate(store["students"])}
+    return store
+
+
+def daily(values, feature):
+    """
+    Reduces the minute axis to the daily value, like Process.aggregate_file does for one file
+
+    :param values: (day, minute) array of one student
+    :param feature: feature(step, calories, etc.) of the values
+    :return: array of the count of 1s for sleep, the mean for heart and the sum otherwise, per day
+    """
+    if feature == 'sleep':
+        return (values == 1).sum(axis=1).astype("float64")
+    present = ~np.isnan(values)
+    totals = np.where(present, values, 0).sum(axis=1)
+    if feature == 'heart':
+        counts = present.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, totals / counts, np.nan)
+    return totals
+
+
+def records(store, feature, ID, statistics=()):
+    """
+    Daily values of one student, in the form of Process.aggregate_student
+
+    :param store: store dict from open_store
+    :param feature: feature(step, calories, etc.) of which data is being processed
+    :param ID: student folder name
+    :param statistics: names of extra statistics to compute (see intraday.STATISTICS)
+    :return: list of (date, None, daily value) of the days the store holds for the student, empty for a student
+             it does not hold, with statistics the value is a tuple like in Process.aggregate_file
+    """
+    s = store["students"].get(ID)
+    if s is None:
+        return []
+    # One student at a time, so only that student's part of the array is read
+    values = np.asarray(store["values"][feature][s])
+    rows = store["rows"][feature][s]
+    days = np.flatnonzero(rows >= 0)
+    totals = daily(values[days], feature)
+    result = []
+    for d, total in zip(days, totals):
+        value = total
+        if statistics:
+            value = (total, intraday.compute(values[d, :rows[d]], statistics))
+        result.append((store["dates"][d], None, value))
+    return result
@@ -1,96 +1,204 @@
 import os
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 
+import frames
+import instrument
 
-def student(folder_path, output_file_path):
+# Survey features in column order: (feature, column pattern, aggregation).
+# 'value' takes the column named exactly like the pattern, 'sum' adds up every column containing the pattern
+# and 'sum_nonzero' does the same but treats a total of 0 as unanswered.
+SURVEY_SCHEMA = (
+    ('CESD', 'CESD', 'value'),
+    ('STAI', 'STAI_St_', 'sum_nonzero'),
+    ('ThermalSens', 'ThermalSens', 'sum'),
+    ('TempSatisf', 'TempSatisf', 'sum'),
+    ('ThermEnh/Int', 'ThermEnh/Int', 'sum'),
+    ('AirSatisf_1', 'AirSatisf_1', 'sum'),
+    ('OutdoorAirAmount_1', 'OutdoorAirAmount_1', 'sum'),
+    ('AirEnh/Int_1', 'AirEnh/Int_1', 'sum'),
+    ('LightSatisf_1', 'LightSatisf_1', 'sum'),
+    ('LightSatisf_2', 'LightSatisf_2', 'sum'),
+    ('LightAmount_1', 'LightAmount_1', 'sum'),
+    ('LightEnh/Int_1', 'LightEnh/Int_1', 'sum'),
+    ('NoiseSatisf_1', 'NoiseSatisf_1', 'sum'),
+    ('NoiseEnh/Int_1', 'NoiseEnh/Int_1', 'sum'),
+    ('EnvSatisf_1', 'EnvSatisf_1', 'sum'),
+    ('LearnIncr/Decr_1', 'LearnIncr/Decr_1', 'sum'),
+    ('CPUSpeed_1', 'CPUSpeed_1', 'sum'),
+    ('InternetSpeed_1', 'InternetSpeed_1', 'sum'),
+    ('DownloadSpeed', 'DownloadSpeed', 'sum'),
+    ('UploadSpeed', 'UploadSpeed', 'sum'),
+)
+
+
+def student(folder_path, output_file_path, executor=None, students=None, join='merge'):
     """
-    Runs all to get one student concatenated information on one feature
+    Adds the survey answers of every student in the term to the term CSV
 
     :param folder_path: path of the term folder
-    :param combined_data: data frame to put information in
-    :return: dataframe containing concatenation of given feature for given student
+    :param output_file_path: path of the term csv to read and write back
+    :param executor: optional concurrent.futures executor to parse the students on
+    :param students: optional list of the student folders to read, all of them by default
+    :param join: how the surveys are joined onto the days (see add_surveys)
+    :return: void
     """
 
     output_directory = os.path.dirname(output_file_path)
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     if os.path.exists(output_file_path):
-        combined_data = pd.read_csv(output_file_path)
+        combined_data = frames.read_frame(output_file_path)
     else:
         combined_data = pd.DataFrame()
-    # Iterate through all files in the folder
-    for student_dir in os.listdir(folder_path):
-        ID = student_dir
-        student_dir_path = os.path.join(folder_path, student_dir)
-        if os.path.isdir(student_dir_path):
-            # Initialize an empty DataFrame for the current student
-            student_data = {'Date': [], 'CESD': []}
-            # Iterate through all Excel files in the Survey directory
-            survey_path = os.path.join(student_dir_path, "Survey")
-            for filename in os.listdir(survey_path):
-                if filename.endswith(".csv"):
-                    file_path = os.path.join(survey_path, filename)
-                    # Read each Excel file into a DataFrame
-                    df = pd.read_csv(file_path)
-
-                    student_data['Date'].extend(df['StartDate'])
-                    student_data['CESD'].extend(df['CESD'])
-                    student_data['STAI'] = df.filter(like='STAI_St_').sum(axis=1)
-                    student_data['ThermalSens'] = df.filter(like='ThermalSens').sum(axis=1)
-                    student_data['TempSatisf'] = df.filter(like='TempSatisf').sum(axis=1)
-                    student_data['ThermEnh/Int'] = df.filter(like='ThermEnh/Int').sum(axis=1)
-                    student_data['AirSatisf_1'] = df.filter(like='AirSatisf_1').sum(axis=1)
-                    student_data['OutdoorAirAmount_1'] = df.filter(like='OutdoorAirAmount_1').sum(axis=1)
-                    student_data['AirEnh/Int_1'] = df.filter(like='AirEnh/Int_1').sum(axis=1)
-                    student_data['LightSatisf_1'] = df.filter(like='LightSatisf_1').sum(axis=1)
-                    student_data['LightSatisf_2'] = df.filter(like='LightSatisf_2').sum(axis=1)
-                    student_data['LightAmount_1'] = df.filter(like='LightAmount_1').sum(axis=1)
-                    student_data['LightEnh/Int_1'] = df.filter(like='LightEnh/Int_1').sum(axis=1)
-                    student_data['NoiseSatisf_1'] = df.filter(like='NoiseSatisf_1').sum(axis=1)
-                    student_data['NoiseEnh/Int_1'] = df.filter(like='NoiseEnh/Int_1').sum(axis=1)
-                    student_data['EnvSatisf_1'] = df.filter(like='EnvSatisf_1').sum(axis=1)
-                    student_data['LearnIncr/Decr_1'] = df.filter(like='LearnIncr/Decr_1').sum(axis=1)
-                    student_data['CPUSpeed_1'] = df.filter(like='CPUSpeed_1').sum(axis=1)
-                    student_data['InternetSpeed_1'] = df.filter(like='InternetSpeed_1').sum(axis=1)
-                    student_data['DownloadSpeed'] = df.filter(like='DownloadSpeed').sum(axis=1)
-                    student_data['UploadSpeed'] = df.filter(like='UploadSpeed').sum(axis=1)
-
-
-
-
-            # Create a DataFrame for the current student
-            student_df = pd.DataFrame(student_data)
-            student_df = student_df.rename(columns={'CESD': "CESD" + "_" + ID})
-            student_df['STAI'] = np.where(student_df['STAI'] == 0, np.nan, student_df['STAI'])
-            student_df = student_df.rename(columns={'STAI': "STAI" + "_" + ID})
-            student_df = student_df.rename(columns={'ThermalSens': "ThermalSens" + "_" + ID})
-            student_df = student_df.rename(columns={'TempSatisf': "TempSatisf" + "_" + ID})
-            student_df = student_df.rename(columns={'ThermEnh/Int': "ThermEnh/Int" + "_" + ID})
-            student_df = student_df.rename(columns={'AirSatisf_1': "AirSatisf_1" + "_" + ID})
-            student_df = student_df.rename(columns={'OutdoorAirAmount_1': "OutdoorAirAmount_1" + "_" + ID})
-            student_df = student_df.rename(columns={'AirEnh/Int_1': "AirEnh/Int_1" + "_" + ID})
-            student_df = student_df.rename(columns={'LightSatisf_1': "LightSatisf_1" + "_" + ID})
-            student_df = student_df.rename(columns={'LightSatisf_2': "LightSatisf_2" + "_" + ID})
-            student_df = student_df.rename(columns={'LightAmount_1': 'LightAmount_1' + '_' + ID})
-            student_df = student_df.rename(columns={'LightEnh/Int_1': 'LightEnh/Int_1' + '_' + ID})
-            student_df = student_df.rename(columns={'NoiseSatisf_1': 'NoiseSatisf_1' + '_' + ID})
-            student_df = student_df.rename(columns={'NoiseEnh/Int_1': 'NoiseEnh/Int_1' + '_' + ID})
-            student_df = student_df.rename(columns={'EnvSatisf_1': 'EnvSatisf_1' + '_' + ID})
-            student_df = student_df.rename(columns={'LearnIncr/Decr_1': 'LearnIncr/Decr_1' + '_' + ID})
-            student_df = student_df.rename(columns={'CPUSpeed_1': 'CPUSpeed_1' + '_' + ID})
-            student_df = student_df.rename(columns={'InternetSpeed_1': 'InternetSpeed_1' + '_' + ID})
-            student_df = student_df.rename(columns={'DownloadSpeed': 'DownloadSpeed' + '_' + ID})
-            student_df = student_df.rename(columns={'UploadSpeed': 'UploadSpeed' + '_' + ID})
-
-
-            # Merge the student DataFrame with the combined data on the 'Date' column
-            if combined_data.empty:
-                combined_data = student_df
-            else:
-                student_df['Date'] = pd.to_datetime(student_df['Date'])
-                combined_data['Date'] = pd.to_datetime(combined_data['Date'])
-                combined_data = pd.merge(combined_data, student_df, on='Date', how='outer',
-                                         suffixes=('', f'_{student_dir}'))
+    combined_data = add_surveys(folder_path, combined_data, executor, students, join)
+    frames.write_frame(combined_data, output_file_path)
+
+
+def add_surveys(folder_path, combined_data, executor=None, students=None, join='merge'):
+    """
+    Runs all to get one student concatenated information on one feature
+
+    :param folder_path: path of the term folder
+    :param combined_data: data frame to put information in
+    :param executor: optional concurrent.futures executor to parse the students on
+    :param students: optional list of the student folders to read, all of them by default
+    :param join: 'merge' adds a row for every survey submission, 'asof' gives every day of combined_data
+                 the answers of the next submission instead (see attach_surveys)
+    :return: combined_data with every student's survey columns, sorted by 'Date'
+    """
+    # Iterate through all student folders in the term
+    if students is None:
+        student_dirs = [student_dir for student_dir in os.listdir(folder_path)
+                        if os.path.isdir(os.path.join(folder_path, student_dir))]
+    else:
+        student_dirs = list(students)
+    student_dir_paths = [os.path.join(folder_path, student_dir) for student_dir in student_dirs]
+    if executor is None:
+        student_dfs = map(student_surveys, student_dir_paths, student_dirs)
+    else:
+        student_dfs = []
+        for student_df, counts in executor.map(student_surveys_counted, student_dir_paths, student_dirs):
+            instrument.merge(counts)
+            student_dfs.append(student_df)
+    if join == 'asof':
+        return attach_surveys(combined_data, student_dfs)
+
+    columns = {}
+    for student_df in student_dfs:
+        # Keep the student's columns as records and build the wide layout once at the end
+        student_dates = pd.to_datetime(student_df['Date'])
+        for column in student_df.columns:
+            if column != 'Date':
+                columns[column] = (student_dates, student_df[column])
+    if not combined_data.empty:
+        combined_data['Date'] = pd.to_datetime(combined_data['Date'])
+    combined_data = frames.widen(combined_data, columns)
     combined_data = combined_data.sort_values(by='Date')
-    combined_data.to_csv(output_file_path, index=False)
+    return combined_data
+
+
+def attach_surveys(combined_data, student_dfs):
+    """
+    Gives every day the answers of the student's next survey submission with a sorted as-of join,
+    which is what imputation.fill_surveys gives the days after add_surveys' outer merge,
+    without adding a row per submission
+
+    :param combined_data: data frame of the days, with a 'Date' column
+    :param student_dfs: data frames from student_surveys
+    :return: combined_data with every student's survey columns, sorted by 'Date'
+    """
+    if 'Date' not in combined_data:
+        # No days to give the answers to
+        return combined_data
+    combined_data['Date'] = pd.to_datetime(combined_data['Date'])
+    combined_data = combined_data.sort_values(by='Date').reset_index(drop=True)
+    days = combined_data[['Date']].astype('datetime64[ns]')
+    columns = {}
+    for student_df in student_dfs:
+        events = student_df.assign(Date=pd.to_datetime(student_df['Date'])).dropna(subset=['Date'])
+        events = events.astype({'Date': 'datetime64[ns]'}).sort_values(by='Date', kind='stable')
+        # Later submissions at the same time win, then every submission takes the answers it is missing
+        # from the next ones, like the back-fill does over the rows of the wide table
+        events = events.drop_duplicates(subset='Date', keep='last').bfill()
+        matched = pd.merge_asof(days, events, on='Date', direction='forward')
+        for column in events.columns:
+            if column != 'Date':
+                columns[column] = matched[column].to_numpy()
+    return pd.concat([combined_data, pd.DataFrame(columns, index=combined_data.index)], axis=1)
+
+
+@lru_cache(maxsize=None)
+def compile_header(columns):
+    """
+    Matches the columns of a survey file against SURVEY_SCHEMA, once per distinct header
+
+    :param columns: tuple of the column names of the file
+    :return: tuple of the matched column positions and the feature of each of them
+    """
+    positions, labels = [], []
+    for feature, pattern, aggregation in SURVEY_SCHEMA:
+        for position, column in enumerate(columns):
+            if column == pattern if aggregation == 'value' else pattern in str(column):
+                positions.append(position)
+                labels.append(feature)
+    return tuple(positions), np.array(labels, dtype=object)
+
+
+def student_surveys_counted(student_dir_path, ID):
+    """
+    Runs student_surveys in a pool worker and hands back what it read
+
+    :return: tuple of the result of student_surveys and the counts from instrument.collect
+    """
+    return student_surveys(student_dir_path, ID), instrument.collect()
+
+
+def student_surveys(student_dir_path, ID):
+    """
+    Reads all the survey files of one student and reduces every submission to the features in SURVEY_SCHEMA
+
+    :param student_dir_path: path of the student folder
+    :param ID: ID of the student, used as the column suffix
+    :return: dataframe with a 'Date' column and one column per survey feature
+    """
+    features = [feature for feature, pattern, aggregation in SURVEY_SCHEMA]
+    dates, parts = [], []
+    # Iterate through all Excel files in the Survey directory
+    survey_path = os.path.join(student_dir_path, "Survey")
+    for filename in os.listdir(survey_path):
+        if filename.endswith(".csv"):
+            file_path = os.path.join(survey_path, filename)
+            # Read each Excel file into a DataFrame
+            df = frames.read_frame(file_path)
+            positions, labels = compile_header(tuple(df.columns))
+            values = df.iloc[:, list(positions)].apply(pd.to_numeric, errors='coerce').to_numpy()
+            # One long record per (submission, matched column), numbered across all of the student's files
+            submissions = np.arange(len(dates), len(dates) + len(df))
+            parts.append(pd.DataFrame({'submission': np.repeat(submissions, len(positions)),
+                                       'feature': np.tile(labels, len(df)),
+                                       'value': values.ravel()}))
+            dates.extend(df['StartDate'])
+
+    if parts:
+        long_df = pd.concat(parts, ignore_index=True)
+    else:
+        long_df = pd.DataFrame({'submission': [], 'feature': [], 'value': []})
+    grouped = long_df.groupby(['submission', 'feature'])['value'].agg(['sum', 'count'])
+    sums = grouped['sum'].unstack('feature').reindex(index=range(len(dates)), columns=features)
+    counts = grouped['count'].unstack('feature').reindex(index=range(len(dates)), columns=features)
+
+    student_df = pd.DataFrame({'Date': dates})
+    for feature, pattern, aggregation in SURVEY_SCHEMA:
+        column = sums[feature]
+        if aggregation == 'value':
+            column = column.where(counts[feature] > 0)
+        else:
+            # A sum over no answered columns is 0, like DataFrame.sum
+            column = column.fillna(0)
+            if aggregation == 'sum_nonzero':
+                column = column.where(column != 0)
+        student_df[feature] = column.to_numpy()
+
+    return student_df.rename(columns={feature: feature + "_" + ID for feature in features})
@@ -0,0 +1,154 @@
+# Generates synthetic cohorts laid out like the raw Fitbit and survey exports, for benchmarks and trying out changes
+
+import argparse
+import os
+from datetime import date, timedelta
+
+import numpy as np
+
+from Preprocess import SUMMARY_PREFIXES
+from imputation import SURVEY_PREFIXES
+
+# Columns of each intraday file, the data column positions match Process.FEATURES
+INTRADAY_COLUMNS = {
+    "ID": ["Time", "Value"],
+    "step": ["Time", "Value"],
+    "heart": ["Time", "Value"],
+    "distance": ["Time", "Value"],
+    "sleep": ["Time", "Value"],
+    "calories": ["Time", "Level", "Value"],
+}
+
+
+def _times(rows):
+    """
+    Time stamps of the rows of one intraday file, spread over a day
+
+    :param rows: number of rows in the file
+    :return: list of HH:MM:SS strings
+    """
+    seconds = np.arange(rows) * (86400 // max(1, rows))
+    return [f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in seconds]
+
+
+def _values(feature, rows, rng):
+    """
+    Random data columns of one intraday file
+
+    :param feature: feature(step, calories, etc.) of the file
+    :param rows: number of rows in the file
+    :param rng: numpy random generator
+    :return: list of columns, each a list of strings
+    """
+    if feature == "heart":
+        values = rng.integers(50, 130, rows).astype(str).astype(object)
+        values[rng.random(rows) < 0.1] = ""  # gaps where the watch lost contact
+        return [values]
+    if feature == "sleep":
+        return [rng.integers(0, 4, rows).astype(str)]
+    if feature == "distance":
+        return [np.round(rng.random(rows) * 0.05, 4).astype(str)]
+    if feature == "calories":
+        return [rng.integers(0, 3, rows).astype(str), np.round(rng.random(rows) * 3, 3).astype(str)]
+    if feature == "step":
+        # Some days the watch is barely worn, which the imputation takes out
+        high = 2 if rng.random() < 0.15 else 20
+        return [rng.integers(0, high, rows).astype(str)]
+    return [np.full(rows, "1")]
+
+
+def _write(file_path, header, columns):
+    """
+    Writes a csv file from columns of strings
+
+    :param file_path: path of the file
+    :param header: list of column names
+    :param columns: list of columns, each a list of strings
+    :return: void
+    """
+    with open(file_path, "w") as f:
+        f.write(",".join(header) + "\n")
+        f.write("\n".join(",".join(row) for row in zip(*columns)))
+        f.write("\n")
+
+
+def generate_student(student_path, start, days, rows, rng, months=True, missing=0.1, survey_every=7):
+    """
+    Generates the Fitbit and Survey folders of one student
+
+    :param student_path: folder of the student
+    :param start: date of the first day
+    :param days: number of days of data
+    :param rows: rows per intraday file
+    :param rng: numpy random generator
+    :param months: sort the Fitbit files into month folders like some exports do
+    :param missing: share of days without any Fitbit file
+    :param survey_every: days between two surveys
+    :return: void
+    """
+    fitbit_path = os.path.join(student_path, "Fitbit")
+    os.makedirs(fitbit_path, exist_ok=True)
+    times = _times(rows)
+    for day in range(days):
+        if rng.random() < missing:
+            continue
+        current = start + timedelta(days=day)
+        folder = os.path.join(fitbit_path, current.strftime("%B %Y")) if months else fitbit_path
+        os.makedirs(folder, exist_ok=True)
+        for feature, header in INTRADAY_COLUMNS.items():
+            _write(os.path.join(folder, f"{feature}_{current:%Y%m%d}.csv"), header,
+                   [times] + _values(feature, rows, rng))
+    for prefix in SUMMARY_PREFIXES:
+        _write(os.path.join(fitbit_path, f"{prefix}_{start:%Y%m%d}.csv"), ["Date", "Value"], [["x"], ["0"]])
+
+    survey_path = os.path.join(student_path, "Survey")
+    os.makedirs(survey_path, exist_ok=True)
+    surveys = max(1, days // survey_every)
+    header = ["StartDate", "CESD"] + [f"STAI_St_{i}" for i in range(1, 21)] + list(SURVEY_PREFIXES[2:])
+    columns = [[f"{start + timedelta(days=(i + 1) * survey_every - 1):%Y-%m-%d} 10:00:00" for i in range(surveys)],
+               rng.integers(0, 40, surveys).astype(str)]
+    columns += [rng.integers(1, 5, surveys).astype(str) for i in range(20)]
+    columns += [rng.integers(1, 8, surveys).astype(str) for prefix in SURVEY_PREFIXES[2:]]
+    _write(os.path.join(survey_path, "survey.csv"), header, columns)
+
+
+def generate(root, cohorts=2, students=10, days=14, rows=1440, seed=0, missing=0.1, survey_every=7):
+    """
+    Generates a data folder with one folder per cohort, in the layout main.process expects.
+    Half of the students have their files sorted into month folders and every cohort has one
+    student without Fitbit data, so every preprocessing step has work to do.
+
+    :param root: data folder to create
+    :param cohorts: number of cohorts
+    :param students: students per cohort
+    :param days: days of data per student
+    :param rows: rows per intraday file, 1440 for minute data
+    :param seed: seed of the random data
+    :param missing: share of days without any Fitbit file
+    :param survey_every: days between two surveys
+    :return: list of the cohort folders
+    """
+    rng = np.random.default_rng(seed)
+    start = date(2023, 1, 9)
+    cohort_paths = []
+    for c in range(cohorts):
+        cohort_path = os.path.join(root, f"Term{c + 1}")
+        cohort_paths.append(cohort_path)
+        for s in range(students):
+            generate_student(os.path.join(cohort_path, f"{c + 1}{s:04d}"), start + timedelta(days=70 * c), days,
+                             rows, rng, months=s % 2 == 1, missing=missing, survey_every=survey_every)
+        os.makedirs(os.path.join(cohort_path, "no_data", "Fitbit"), exist_ok=True)
+        os.makedirs(os.path.join(cohort_path, "no_data", "Survey"), exist_ok=True)
+    return cohort_paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic data folder")
+    parser.add_argument("root")
+    parser.add_argument("--cohorts", type=int, default=2)
+    parser.add_argument("--students", type=int, default=10)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--rows", type=int, default=1440)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.root, args.cohorts, args.students, args.days, args.rows, args.seed)